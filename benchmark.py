@@ -0,0 +1,349 @@
+"""
+Copy4bk 性能基准测试
+
+在本地磁盘或 tmpfs 上生成可复现的模拟发布目录，按阶段计时：
+配置解析（config，以及命中缓存的 config_cached）、扫描（scan）、选择最新版本（select）、复制（copy）、清理旧版本（clean），
+输出每个阶段的耗时、ops/s 和 MB/s，并可保存为 JSON，用于对比两次运行是否出现性能回退。
+完全离线运行，不访问网络。
+
+示例：
+    python benchmark.py --subdirs 200 --versions 8 --sizes 4K:60,512K:35,16M:5 --targets 2 --json bench.json
+    python benchmark.py --tmpfs --baseline bench.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import contextlib
+from datetime import datetime
+
+import main
+
+
+BENCH_FORMAT_VERSION = 1
+DEFAULT_SIZES = '4K:60,512K:35,8M:5'  # 文件大小分布：大小:权重
+CONFIG_PARSE_ITERATIONS = 200         # 配置解析阶段每轮重复解析的次数
+DATA_BLOCK_SIZE = 1024 * 1024         # 生成文件内容时复用的随机数据块大小
+DEFAULT_REGRESSION_THRESHOLD = 0.10   # 与基线相比慢多少算作回退
+
+
+def parse_size_distribution(text):
+    """解析 '4K:60,512K:35,8M:5' 格式的大小分布，返回 [(字节数, 权重), ...]"""
+    distribution = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        size, _, weight = item.partition(':')
+        distribution.append((main.parse_size(size), float(weight or 1)))
+    if not distribution:
+        raise ValueError(text)
+    return distribution
+
+
+def _random_bytes(rng, n):
+    """等价于 Random.randbytes（Python 3.9+），兼容 Python 3.6"""
+    return rng.getrandbits(n * 8).to_bytes(n, 'little') if n else b''
+
+
+def _write_file(path, size, block, rng):
+    """写入 size 字节：复用同一个随机数据块，开头写入随机前缀使每个文件内容不同"""
+    with open(path, 'wb') as f:
+        f.write(_random_bytes(rng, min(size, 64)))
+        remaining = size - min(size, 64)
+        while remaining > 0:
+            chunk = block[:remaining]
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+def _sparse_file(path, size):
+    """只需要文件名和大小的文件（旧版本）用稀疏文件生成，不写入实际数据"""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def _version_name(subdir_index, version_index):
+    return f"App{subdir_index:04d}_v1.{version_index}.{100 + version_index}.exe"
+
+
+def generate_tree(root, subdirs, versions, sizes, seed=0):
+    """
+    在 root/source 下生成模拟发布目录：subdirs 个子目录，每个子目录 versions 个版本文件，
+    外加一个不带版本号的说明文件。文件大小按 sizes 分布随机抽取（同一子目录的各版本大小相同），
+    修改时间随版本号递增。只有最新版本写入实际数据，旧版本为稀疏文件
+    返回 {'source': 源目录, 'files': 文件数, 'latest_bytes': 最新版本总字节数, 'layout': [(子目录, 大小), ...]}
+    """
+    rng = random.Random(seed)
+    block = _random_bytes(random.Random(seed), DATA_BLOCK_SIZE)
+    source = os.path.join(root, 'source')
+    os.makedirs(source, exist_ok=True)
+    choices = [size for size, _ in sizes]
+    weights = [weight for _, weight in sizes]
+    base_mtime = 1_600_000_000
+
+    layout = []
+    latest_bytes = 0
+    files = 0
+    for i in range(subdirs):
+        subdir_name = f"App{i:04d}"
+        subdir = os.path.join(source, subdir_name)
+        os.makedirs(subdir, exist_ok=True)
+        size = rng.choices(choices, weights)[0]
+        for v in range(versions):
+            path = os.path.join(subdir, _version_name(i, v))
+            if v == versions - 1:
+                _write_file(path, size, block, rng)
+            else:
+                _sparse_file(path, size)
+            mtime = base_mtime + v * 3600
+            os.utime(path, (mtime, mtime))
+            files += 1
+        with open(os.path.join(subdir, 'readme.txt'), 'w', encoding='utf-8') as f:
+            f.write(subdir_name)
+        files += 1
+        layout.append((subdir_name, size))
+        latest_bytes += size
+    return {'source': source, 'files': files, 'latest_bytes': latest_bytes, 'layout': layout}
+
+
+def seed_targets(root, layout, targets, versions):
+    """
+    重建 targets 个目标目录，每个子目录预先放入除最新版本外的全部旧版本（稀疏文件），
+    供清理阶段删除。返回目标目录列表
+    """
+    target_dirs = []
+    for t in range(targets):
+        target = os.path.join(root, f"target{t}")
+        shutil.rmtree(target, ignore_errors=True)
+        for i, (subdir_name, size) in enumerate(layout):
+            subdir = os.path.join(target, subdir_name)
+            os.makedirs(subdir, exist_ok=True)
+            for v in range(versions - 1):
+                _sparse_file(os.path.join(subdir, _version_name(i, v)), size)
+        target_dirs.append(target)
+    return target_dirs
+
+
+def write_config(root, source, target_dirs):
+    """写出基准测试用的配置文件：清理旧文件、直接覆盖、不写同步清单"""
+    config_path = os.path.join(root, 'copy4bk-bench.txt')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        f.write("# Copy4bk 基准测试配置（自动生成）\n")
+        f.write("select=version\n")
+        f.write(f"source={source}\n")
+        for target in target_dirs:
+            f.write(f"target={target} --clean_old true --keep 1 --conflict overwrite --manifest false\n")
+    return config_path
+
+
+def _phase_result(durations, ops, num_bytes=0):
+    """汇总一个阶段多轮的耗时；速率按中位数计算"""
+    median = statistics.median(durations)
+    result = {
+        'runs': len(durations),
+        'best_s': round(min(durations), 6),
+        'median_s': round(median, 6),
+        'ops': ops,
+        'ops_per_s': round(ops / median, 1) if median > 0 else None,
+    }
+    if num_bytes:
+        result['bytes'] = num_bytes
+        result['mb_per_s'] = round(num_bytes / median / (1024 * 1024), 1) if median > 0 else None
+    return result
+
+
+@contextlib.contextmanager
+def _quiet(enabled):
+    """屏蔽 main 中逐文件打印的日志，避免终端输出影响计时"""
+    if enabled:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    else:
+        yield
+
+
+def run_benchmark(root, subdirs, versions, sizes, targets, repeat=3, seed=0, scan_workers=1, quiet=True):
+    """生成模拟目录并逐阶段计时，返回可直接写成 JSON 的结果字典"""
+    tree = generate_tree(root, subdirs, versions, sizes, seed)
+    source = tree['source']
+    phases = {}
+
+    target_dirs = seed_targets(root, tree['layout'], targets, versions)
+    config_path = write_config(root, source, target_dirs)
+
+    # 配置解析：config 每次都重新解析；config_cached 为配置文件未修改时命中进程内缓存的耗时
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(CONFIG_PARSE_ITERATIONS):
+            config_plan, _ = main.parse_config_file(config_path)
+        durations.append(time.perf_counter() - start)
+    phases['config'] = _phase_result(durations, CONFIG_PARSE_ITERATIONS)
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(CONFIG_PARSE_ITERATIONS):
+            main.load_config(config_path, cache_path=None)
+        durations.append(time.perf_counter() - start)
+    phases['config_cached'] = _phase_result(durations, CONFIG_PARSE_ITERATIONS)
+
+    settings = config_plan.settings
+    target_configs = main.apply_conflict_policy([(td, dict(cfg)) for td, cfg in config_plan.targets],
+                                                'overwrite', headless=True)
+
+    # 扫描：列出子目录、读取文件信息并选出最新版本（每轮清空版本号缓存，按冷缓存计时）
+    durations = []
+    plan = None
+    for _ in range(repeat):
+        main.parse_version.cache_clear()
+        start = time.perf_counter()
+        plan = main.build_latest_plan(source, settings.get('select', 'version'), workers=scan_workers)
+        durations.append(time.perf_counter() - start)
+    phases['scan'] = _phase_result(durations, tree['files'])
+
+    # 选择：只计算版本号解析和排序键，不含目录 I/O
+    names = [(entry.name, entry.stat().st_mtime_ns)
+             for d in sorted(os.listdir(source)) for entry in os.scandir(os.path.join(source, d))]
+    durations = []
+    for _ in range(repeat):
+        main.parse_version.cache_clear()
+        start = time.perf_counter()
+        for name, mtime_ns in names:
+            version = main.parse_version(name)
+            if version is not None:
+                main._selection_key('both', version, mtime_ns)
+        durations.append(time.perf_counter() - start)
+    phases['select'] = _phase_result(durations, len(names))
+
+    # 复制和清理：每轮先重建目标目录（不计时）
+    copy_durations = []
+    clean_durations = []
+    copied_files = 0
+    deleted_files = 0
+    for r in range(repeat):
+        if r:
+            seed_targets(root, tree['layout'], targets, versions)
+        start = time.perf_counter()
+        with _quiet(quiet):
+            results = main.copy_to_targets(plan, target_configs, announce=False, retention=False)
+        copy_durations.append(time.perf_counter() - start)
+        copied_files = sum(1 for result in results if result.error is None)
+
+        before = sum(len(os.listdir(os.path.join(td, s))) for td, _ in target_configs for s, _ in tree['layout'])
+        start = time.perf_counter()
+        with _quiet(quiet):
+            main.apply_retention_to_targets(plan, target_configs, results)
+        clean_durations.append(time.perf_counter() - start)
+        after = sum(len(os.listdir(os.path.join(td, s))) for td, _ in target_configs for s, _ in tree['layout'])
+        deleted_files = before - after
+    phases['copy'] = _phase_result(copy_durations, copied_files, tree['latest_bytes'] * targets)
+    phases['clean'] = _phase_result(clean_durations, deleted_files)
+
+    return {
+        'format': BENCH_FORMAT_VERSION,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'root': root,
+        'params': {
+            'subdirs': subdirs,
+            'versions': versions,
+            'sizes': [[size, weight] for size, weight in sizes],
+            'targets': targets,
+            'repeat': repeat,
+            'seed': seed,
+            'scan_workers': scan_workers,
+        },
+        'phases': phases,
+    }
+
+
+def print_report(report):
+    print(f"\n参数: {json.dumps(report['params'], ensure_ascii=False)}")
+    print(f"{'phase':<14}{'median(s)':>12}{'best(s)':>12}{'ops':>10}{'ops/s':>14}{'MB/s':>10}")
+    for name, phase in report['phases'].items():
+        mb = phase.get('mb_per_s')
+        print(f"{name:<14}{phase['median_s']:>12.4f}{phase['best_s']:>12.4f}{phase['ops']:>10}"
+              f"{phase['ops_per_s'] or 0:>14.1f}{(f'{mb:.1f}' if mb is not None else '-'):>10}")
+
+
+def compare_reports(report, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """逐阶段对比中位耗时，打印变化比例；返回比基线慢超过 threshold 的阶段名列表"""
+    if baseline.get('params') != report['params']:
+        print("\n注意：基线的参数与本次不同，对比结果仅供参考")
+    regressions = []
+    print(f"\n与基线对比（{baseline.get('timestamp', '未知时间')}）:")
+    for name, phase in report['phases'].items():
+        old = baseline.get('phases', {}).get(name)
+        if not old or not old.get('median_s'):
+            continue
+        change = phase['median_s'] / old['median_s'] - 1
+        mark = ''
+        if change > threshold:
+            mark = '  <-- 回退'
+            regressions.append(name)
+        print(f"  {name:<14}{old['median_s']:>10.4f}s -> {phase['median_s']:.4f}s ({change:+.1%}){mark}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Copy4bk 性能基准测试（离线，使用模拟目录）')
+    parser.add_argument('--subdirs', type=int, default=50, help='子目录数量（默认 50）')
+    parser.add_argument('--versions', type=int, default=5, help='每个子目录的版本文件数（默认 5）')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f'文件大小分布，格式 大小:权重,...（默认 {DEFAULT_SIZES}）')
+    parser.add_argument('--targets', type=int, default=2, help='目标目录数量（默认 2）')
+    parser.add_argument('--repeat', type=int, default=3, help='每个阶段的重复轮数，取中位数（默认 3）')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子，相同种子生成相同的目录（默认 0）')
+    parser.add_argument('--scan-workers', type=int, default=1, help='扫描阶段的并发线程数（默认 1）')
+    parser.add_argument('--root', default=None, help='生成模拟目录的位置（默认系统临时目录）')
+    parser.add_argument('--tmpfs', action='store_true', help='在 /dev/shm 中生成模拟目录，排除磁盘的影响')
+    parser.add_argument('--keep-tree', action='store_true', help='结束后保留模拟目录')
+    parser.add_argument('--json', default=None, metavar='PATH', help='把结果保存为 JSON 文件')
+    parser.add_argument('--baseline', default=None, metavar='PATH', help='与之前保存的 JSON 结果对比')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help=f'比基线慢多少算作回退（默认 {DEFAULT_REGRESSION_THRESHOLD:g}，即 10%%）')
+    parser.add_argument('--verbose', action='store_true', help='显示复制/清理过程的日志')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    sizes = parse_size_distribution(args.sizes)
+
+    parent = args.root
+    if args.tmpfs:
+        parent = '/dev/shm'
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    root = tempfile.mkdtemp(prefix='copy4bk-bench-', dir=parent)
+    print(f"模拟目录: {root}")
+
+    try:
+        report = run_benchmark(root, args.subdirs, args.versions, sizes, args.targets,
+                               repeat=max(1, args.repeat), seed=args.seed,
+                               scan_workers=max(1, args.scan_workers), quiet=not args.verbose)
+    finally:
+        if not args.keep_tree:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.json}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare_reports(report, baseline, args.threshold):
+            sys.exit(1)
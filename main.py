@@ -1,12 +1,30 @@
 import os
 import shutil
 import re
+import threading
+import errno
+import sys
+import json
+import time
+import argparse
+import functools
+import contextlib
+import fnmatch
+import hashlib
+import zlib
+import queue
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 try:
     import msvcrt  # Windows: 支持任意键退出
 except Exception:
     msvcrt = None
+try:
+    import fcntl  # Linux: 用于 FICLONE 反射链接
+except Exception:
+    fcntl = None
 
 
 def print_intro():
@@ -21,211 +39,432 @@ def print_intro():
     print("- 详细日志输出，便于排查")
     print("")
 
-def read_config(config_file='copy4bk-win.txt'):
+def _parse_bool(value):
+    if value not in ('true', 'false'):
+        raise ValueError("应为 true 或 false")
+    return value == 'true'
+
+
+def _parse_int(value, minimum):
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        raise ValueError(f"应为不小于 {minimum} 的整数")
+    return number
+
+
+def _parse_choice(value, choices):
+    if value not in choices:
+        raise ValueError(f"可选: {', '.join(choices)}")
+    return value
+
+
+def _parse_size_value(value):
+    try:
+        return parse_size(value)
+    except ValueError:
+        raise ValueError("应为大小，如 500M、20G") from None
+
+
+# 目标目录选项：--名称 取值；解析函数在取值无效时抛出 ValueError(说明)
+TARGET_OPTIONS = {
+    'clean_old': _parse_bool,
+    'keep': lambda v: _parse_int(v, 1),                      # 每个子目录保留的版本数（含最新版本）
+    'max_bytes': _parse_size_value,                          # 目标目录中保留文件的总大小上限，如 20G
+    'throttle': _parse_size_value,                           # 写入该目标目录的速率上限（字节/秒），如 20M
+    'conflict': lambda v: _parse_choice(v, CONFLICT_POLICIES),
+    'concurrency': lambda v: _parse_int(v, 1),               # 该目标目录同时进行的复制任务数上限
+    'manifest': _parse_bool,
+    'verify': _parse_bool,
+    'hash': lambda v: _parse_choice(v, HASH_ALGORITHMS),
+    'delta': _parse_bool,
+}
+
+# 全局设置：键名（含中文别名） -> (设置名, 解析函数)
+GLOBAL_SETTINGS = {
+    'select': ('select', lambda v: _parse_choice(v, SELECT_POLICIES)),
+    '选择策略': ('select', lambda v: _parse_choice(v, SELECT_POLICIES)),
+    'conflict': ('conflict', lambda v: _parse_choice(v, CONFLICT_POLICIES)),
+    '冲突策略': ('conflict', lambda v: _parse_choice(v, CONFLICT_POLICIES)),
+    'depth': ('depth', lambda v: _parse_int(v, 0)),
+    '遍历深度': ('depth', lambda v: _parse_int(v, 0)),
+    'scan_workers': ('scan_workers', lambda v: _parse_int(v, 1)),
+    '扫描线程数': ('scan_workers', lambda v: _parse_int(v, 1)),
+    'copy_workers': ('copy_workers', lambda v: _parse_int(v, 1)),
+    '复制线程数': ('copy_workers', lambda v: _parse_int(v, 1)),
+    'device_concurrency': ('device_concurrency', lambda v: _parse_int(v, 1)),
+    '设备并发数': ('device_concurrency', lambda v: _parse_int(v, 1)),
+    'throttle': ('throttle', _parse_size_value),
+    '限速': ('throttle', _parse_size_value),
+    'max_inflight': ('max_inflight', _parse_size_value),
+    '最大在途字节': ('max_inflight', _parse_size_value),
+    'priority': ('priority', lambda v: _parse_choice(v, COPY_PRIORITIES)),
+    '复制顺序': ('priority', lambda v: _parse_choice(v, COPY_PRIORITIES)),
+}
+
+SOURCE_KEYS = ('源目录', 'source', '源路径', 'a目录', 'a')
+TARGET_KEYS = ('目标目录', 'target', '目标路径', 'b目录', 'b')
+TARGET_LIST_KEYS = ('目标目录们', '目标列表', 'targets')
+PATTERN_KEYS = ('include', 'exclude')
+
+# 注释行中的目标目录：# target=路径 --clean_old true
+COMMENT_TARGET_PATTERN = re.compile(r'^#\s*target\s*=', re.IGNORECASE)
+# 目标目录行中选项的起点：第一个 --名称（前面可以没有空格），或旧格式的 clean_old=true
+TARGET_OPTIONS_START = re.compile(r'--(?=[a-z_])|(?<=\s)clean_old=', re.IGNORECASE)
+
+# 解析结果：源目录、((目标目录, 选项字典), ...)、全局设置字典
+ConfigPlan = namedtuple('ConfigPlan', ['source_dir', 'targets', 'settings'])
+
+CONFIG_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.copy4bk', 'config-cache.json')
+CONFIG_CACHE_VERSION = 1
+CONFIG_CACHE_MAX_ENTRIES = 32
+_config_cache = {}  # 配置文件绝对路径 -> (st_mtime_ns, 大小, ConfigPlan)
+_config_cache_lock = threading.Lock()
+
+
+def _strip_quotes(text):
+    return text.strip().strip('"').strip("'")
+
+
+def _parse_target_spec(value, line_no, errors):
+    """
+    解析 "路径 --选项 取值 ..."：第一个 -- 之前的都是路径（路径可以包含空格，无需引号）
+    也兼容旧格式 "路径 clean_old=true" 和 "--选项=取值"
+    返回 (路径, 选项字典)；无效的选项记入 errors
+    """
+    match = TARGET_OPTIONS_START.search(value)
+    if match is None:
+        return _strip_quotes(value), {}
+
+    path = _strip_quotes(value[:match.start()])
+    config = {}
+    tokens = value[match.start():].split()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token.startswith('--') and '=' not in token:
+            name = token[2:].lower()
+            if i + 1 >= len(tokens) or tokens[i + 1].startswith('--'):
+                errors.append(f"第 {line_no} 行: 选项 --{name} 缺少取值")
+                i += 1
+                continue
+            option_value = tokens[i + 1].lower()
+            i += 2
+        elif '=' in token:
+            name, option_value = token.lstrip('-').split('=', 1)
+            name, option_value = name.lower(), option_value.lower()
+            i += 1
+        else:
+            errors.append(f"第 {line_no} 行: 无法识别的内容 {token}")
+            i += 1
+            continue
+
+        parser = TARGET_OPTIONS.get(name)
+        if parser is None:
+            errors.append(f"第 {line_no} 行: 未知的目标目录选项 --{name}（可用: {', '.join(TARGET_OPTIONS)}）")
+            continue
+        try:
+            config[name] = parser(option_value)
+        except ValueError as e:
+            errors.append(f"第 {line_no} 行: --{name} 的取值无效: {option_value}（{e}）")
+    return path, config
+
+
+def parse_config_file(config_file):
     """
-    从配置文件中读取源目录和目标目录（支持多目标目录）
+    单遍解析配置文件，返回 (ConfigPlan, 错误列表)；错误信息带行号。读取失败时抛出 OSError
     支持格式：
-    1) 键值对：source=路径；target=路径（可写多行）；targets=路径1,路径2
+    1) 键值对：source=路径；target=路径 --选项 取值（可写多行）；targets=路径1,路径2
     2) 简单格式：第一行是源目录；之后每一行都是一个目标目录
-    3) 注释行配置：支持 # target=路径 clean_old=true/false 格式
+    3) 注释行配置：# target=路径 --clean_old true
+    4) 全局设置：select=version、conflict=skip 等（见 GLOBAL_SETTINGS），include/exclude 可写多行
+    同一目标目录出现多次时合并选项（后出现的优先），保持第一次出现的顺序
     """
-    if not os.path.exists(config_file):
-        print(f"配置文件不存在: {config_file}")
-        return None, []
+    with open(config_file, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
 
     source_dir = None
-    target_configs = []  # 改为存储(target_dir, config_dict)的列表
+    targets = {}  # 目标目录 -> 选项字典；dict 保持插入顺序，查重为 O(1)
+    settings = {}
+    errors = []
 
-    try:
-        with open(config_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+    def add_target(path, config):
+        if path:
+            targets[path] = {**targets[path], **config} if path in targets else config
 
-        current_target = None
-        current_config = {}
+    for line_no, raw_line in enumerate(lines, 1):
+        line = raw_line.strip()
+        if not line:
+            continue
 
-        for raw_line in lines:
-            line = raw_line.strip()
-            
-            # 跳过所有注释行（以 # 开头）
-            if line.startswith('#'):
-                # 处理注释行中的配置：支持 # target=路径 --clean_old true 格式
-                if 'target=' in line:
-                    # 从注释行解析配置，例如：# target=D:\Backup1 --clean_old true
-                    comment_content = line[1:].strip()  # 去掉#号
-                    # 查找 target= 的位置
-                    target_idx = comment_content.find('target=')
-                    if target_idx >= 0:
-                        # 提取 target= 后面的部分
-                        target_part = comment_content[target_idx + 6:].strip()  # 跳过 'target='
-                        # 查找 -- 的位置，区分路径和配置选项
-                        # 支持两种格式：' --clean_old' 或 '--clean_old'（前面可能有或没有空格）
-                        double_dash_idx = target_part.find('--')
-                        if double_dash_idx == -1:
-                            # 没有找到 --，整个就是路径（兼容旧格式）
-                            current_target = target_part.strip().strip('"').strip("'")
-                            current_config = {}
-                            # 检查是否有旧格式的配置（clean_old=true）
-                            parts = target_part.split()
-                            for part in parts[1:]:  # 跳过第一个（路径）
-                                if '=' in part and 'clean_old=' in part:
-                                    clean_old_val = part.split('=', 1)[1].strip().lower()
-                                    current_config['clean_old'] = clean_old_val == 'true'
-                                    # 从路径中移除配置部分
-                                    current_target = parts[0].strip().strip('"').strip("'")
-                        else:
-                            # 找到了 --，分割路径和配置选项
-                            # 从 -- 往前找，确定路径的结束位置（跳过空格）
-                            path_end = double_dash_idx
-                            while path_end > 0 and target_part[path_end - 1] == ' ':
-                                path_end -= 1
-                            current_target = target_part[:path_end].strip().strip('"').strip("'")
-                            current_config = {}
-                            options_str = target_part[double_dash_idx:].strip()  # 从 -- 开始
-                            # 解析配置选项
-                            parts = options_str.split()
-                            i = 0
-                            while i < len(parts):
-                                if parts[i].startswith('--'):
-                                    option_name = parts[i][2:].lower()
-                                    if i + 1 < len(parts):
-                                        option_value = parts[i + 1].lower()
-                                        if option_name == 'clean_old':
-                                            current_config['clean_old'] = option_value == 'true'
-                                        i += 2
-                                    else:
-                                        i += 1
-                                elif '=' in parts[i] and 'clean_old=' in parts[i]:
-                                    # 兼容旧格式
-                                    clean_old_val = parts[i].split('=', 1)[1].strip().lower()
-                                    current_config['clean_old'] = clean_old_val == 'true'
-                                    i += 1
-                                else:
-                                    i += 1
-                        
-                        if current_target:
-                            # 查找是否已有该target的配置
-                            found = False
-                            for idx, (td, cfg) in enumerate(target_configs):
-                                if td == current_target:
-                                    # 更新现有配置
-                                    target_configs[idx] = (current_target, {**cfg, **current_config})
-                                    found = True
-                                    break
-                            if not found:
-                                target_configs.append((current_target, current_config.copy()))
-                        current_target = None
-                        current_config = {}
-                # 所有注释行（无论是否包含target=）都跳过，不继续处理
-                continue
-            
-            if not line:
-                continue
-            
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip().lower()
-                
-                if key in ['源目录', 'source', '源路径', 'a目录', 'a']:
-                    # 源目录直接取value，去掉引号
-                    source_dir = value.strip().strip('"').strip("'")
-                elif key in ['目标目录', 'target', '目标路径', 'b目录', 'b']:
-                    # 处理 target=路径 --clean_old true 格式
-                    # 使用 -- 前缀来区分配置选项，避免路径包含空格时的混淆
-                    value = value.strip()
-                    target_path = None
-                    target_config = {}
-                    
-                    # 查找 -- 的位置，-- 之前的都是路径，之后的是配置选项
-                    # 支持两种格式：' --clean_old' 或 '--clean_old'（前面可能有或没有空格）
-                    double_dash_idx = value.find('--')
-                    if double_dash_idx == -1:
-                        # 没有找到 --，整个value就是路径
-                        target_path = value.strip().strip('"').strip("'")
-                    else:
-                        # 找到了 --，分割路径和配置选项
-                        # 从 -- 往前找，确定路径的结束位置（跳过空格）
-                        path_end = double_dash_idx
-                        while path_end > 0 and value[path_end - 1] == ' ':
-                            path_end -= 1
-                        target_path = value[:path_end].strip().strip('"').strip("'")
-                        options_str = value[double_dash_idx:].strip()  # 从 -- 开始
-                        
-                        # 解析配置选项，格式：--clean_old true 或 --clean_old false
-                        # 也兼容旧格式 clean_old=true（向后兼容）
-                        parts = options_str.split()
-                        i = 0
-                        while i < len(parts):
-                            if parts[i].startswith('--'):
-                                # 新格式：--clean_old true
-                                option_name = parts[i][2:].lower()  # 去掉 --
-                                if i + 1 < len(parts):
-                                    option_value = parts[i + 1].lower()
-                                    if option_name == 'clean_old':
-                                        target_config['clean_old'] = option_value == 'true'
-                                    i += 2
-                                else:
-                                    i += 1
-                            elif '=' in parts[i]:
-                                # 旧格式：clean_old=true（向后兼容）
-                                option_pair = parts[i].split('=', 1)
-                                option_name = option_pair[0].strip().lower()
-                                option_value = option_pair[1].strip().lower()
-                                if option_name == 'clean_old':
-                                    target_config['clean_old'] = option_value == 'true'
-                                i += 1
-                            else:
-                                i += 1
-                    
-                    if target_path:
-                        # 检查是否已有该target的配置
-                        found = False
-                        for idx, (td, cfg) in enumerate(target_configs):
-                            if td == target_path:
-                                # 合并配置
-                                target_configs[idx] = (target_path, {**cfg, **target_config})
-                                found = True
-                                break
-                        if not found:
-                            target_configs.append((target_path, target_config))
-                elif key in ['目标目录们', '目标列表', 'targets']:
-                    # 多个目标目录，逗号/分号分隔
-                    parts = [p.strip() for p in value.replace('；', ';').replace('，', ',').replace(';', ',').split(',')]
-                    for p in parts:
-                        if p:
-                            found = False
-                            for idx, (td, cfg) in enumerate(target_configs):
-                                if td == p:
-                                    found = True
-                                    break
-                            if not found:
-                                target_configs.append((p, {}))
+        if line.startswith('#'):
+            # 注释行只识别 # target=路径，其余注释都跳过
+            match = COMMENT_TARGET_PATTERN.match(line)
+            if match:
+                add_target(*_parse_target_spec(line[match.end():].strip(), line_no, errors))
+            continue
+
+        if '=' not in line:
+            # 简单格式：第一行为源目录，其余每行为一个目标目录
+            if source_dir is None:
+                source_dir = _strip_quotes(line)
             else:
-                # 简单格式：第一行为源目录，其余每行为一个目标目录
-                if source_dir is None:
-                    source_dir = line.strip().strip('"').strip("'")
-                else:
-                    target_val = line.strip().strip('"').strip("'")
-                    found = False
-                    for idx, (td, cfg) in enumerate(target_configs):
-                        if td == target_val:
-                            found = True
-                            break
-                    if not found:
-                        target_configs.append((target_val, {}))
+                add_target(_strip_quotes(line), {})
+            continue
 
-    except Exception as e:
+        key, value = line.split('=', 1)
+        key = key.strip().lower()
+        value = value.strip()
+
+        if key in SOURCE_KEYS:
+            source_dir = _strip_quotes(value)
+        elif key in TARGET_KEYS:
+            add_target(*_parse_target_spec(value, line_no, errors))
+        elif key in TARGET_LIST_KEYS:
+            # 多个目标目录，逗号/分号分隔
+            for path in value.replace('；', ';').replace('，', ',').replace(';', ',').split(','):
+                add_target(path.strip(), {})
+        elif key in PATTERN_KEYS:
+            # 目录过滤模式，逗号分隔，可写多行
+            patterns = [p.strip() for p in value.replace('，', ',').split(',') if p.strip()]
+            settings.setdefault(key, []).extend(patterns)
+        elif key in GLOBAL_SETTINGS:
+            name, parser = GLOBAL_SETTINGS[key]
+            try:
+                settings[name] = parser(value.lower())
+            except ValueError as e:
+                errors.append(f"第 {line_no} 行: {key} 的取值无效: {value}（{e}）")
+
+    plan = ConfigPlan(source_dir, tuple(targets.items()), settings)
+    return plan, errors
+
+
+def _load_cached_plan(key, st, cache_path):
+    """先查进程内缓存，再查磁盘缓存；配置文件的修改时间和大小都一致才算命中"""
+    with _config_cache_lock:
+        cached = _config_cache.get(key)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    if not cache_path:
+        return None
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            entry = json.load(f).get('entries', {}).get(key)
+        if (entry is None or entry.get('version') != CONFIG_CACHE_VERSION
+                or entry.get('mtime_ns') != st.st_mtime_ns or entry.get('size') != st.st_size):
+            return None
+        plan = ConfigPlan(entry['source_dir'], tuple((td, cfg) for td, cfg in entry['targets']),
+                          entry['settings'])
+    except (OSError, ValueError, TypeError, AttributeError, KeyError):
+        return None
+    with _config_cache_lock:
+        _config_cache[key] = (st.st_mtime_ns, st.st_size, plan)
+    return plan
+
+
+def _store_cached_plan(key, st, plan, cache_path):
+    with _config_cache_lock:
+        _config_cache[key] = (st.st_mtime_ns, st.st_size, plan)
+    if not cache_path:
+        return
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f).get('entries', {})
+        if not isinstance(entries, dict):
+            entries = {}
+    except (OSError, ValueError, AttributeError):
+        entries = {}
+    entries.pop(key, None)
+    entries[key] = {'version': CONFIG_CACHE_VERSION, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+                    'source_dir': plan.source_dir, 'targets': [list(t) for t in plan.targets],
+                    'settings': plan.settings}
+    # 只保留最近写入的若干个配置文件
+    while len(entries) > CONFIG_CACHE_MAX_ENTRIES:
+        entries.pop(next(iter(entries)))
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"保存配置缓存失败 {cache_path}: {str(e)}")
+
+
+def load_config(config_file='copy4bk-win.txt', cache_path=CONFIG_CACHE_PATH):
+    """
+    读取配置文件，返回 ConfigPlan；文件不存在、读取失败或有错误时打印原因（错误带行号）并返回 None
+    解析结果按配置文件的修改时间和大小缓存在进程内和 cache_path 中，文件未修改时不再重新解析
+    cache_path 为 None 时只使用进程内缓存
+    """
+    try:
+        st = os.stat(config_file)
+    except OSError:
+        print(f"配置文件不存在: {config_file}")
+        return None
+
+    key = os.path.abspath(config_file)
+    plan = _load_cached_plan(key, st, cache_path)
+    if plan is not None:
+        return plan
+
+    try:
+        plan, errors = parse_config_file(config_file)
+    except (OSError, UnicodeDecodeError) as e:
         print(f"读取配置文件失败: {str(e)}")
+        return None
+    if errors:
+        print(f"配置文件 {config_file} 有 {len(errors)} 处错误:")
+        for error in errors:
+            print(f"  {error}")
+        return None
+
+    _store_cached_plan(key, st, plan, cache_path)
+    return plan
+
+
+def read_config(config_file='copy4bk-win.txt', settings=None, cache_path=CONFIG_CACHE_PATH):
+    """
+    从配置文件中读取源目录和目标目录（支持多目标目录），格式见 parse_config_file
+    settings: 传入字典时，全局设置（如 select=version、conflict=skip）写入该字典
+    cache_path: 解析结果的缓存文件，见 load_config；预演时传入 None，不写任何文件
+    返回 (源目录, [(目标目录, 配置字典), ...])；配置文件有误时返回 (None, [])
+    返回的字典都是副本，调用方可以随意修改
+    """
+    plan = load_config(config_file, cache_path)
+    if plan is None:
         return None, []
+    if settings is not None:
+        settings.update({name: list(value) if isinstance(value, list) else value
+                         for name, value in plan.settings.items()})
+    return plan.source_dir, [(td, dict(cfg)) for td, cfg in plan.targets]
 
-    # 去重并保持顺序
-    dedup_configs = []
-    seen = set()
-    for td, cfg in target_configs:
-        if td not in seen:
-            dedup_configs.append((td, cfg))
-            seen.add(td)
 
-    return source_dir, dedup_configs
+# 运行指标：各阶段耗时和计数，供 --report 输出 JSON 报告和结束时的汇总
+class RunMetrics:
+    """
+    记录一次运行的计时和计数，分别按全局、目标目录、子目录汇总，可在多个线程中同时调用
+    - add(name, value, target, subdir)：累加计数或耗时（耗时类以 _s 结尾，单位秒）
+    - phase(name)：上下文管理器，累加一个阶段的耗时；同一阶段可多次进入（如边扫描边复制）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.targets = {}
+        self.subdirs = {}
+
+    def add(self, name, value=1, target=None, subdir=None):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if target is not None:
+                bucket = self.targets.setdefault(str(target), {})
+                bucket[name] = bucket.get(name, 0) + value
+            if subdir is not None:
+                bucket = self.subdirs.setdefault(subdir, {})
+                bucket[name] = bucket.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def report(self):
+        """返回可直接写成 JSON 的报告；复制吞吐量按复制阶段的实际耗时计算"""
+        def rounded(values):
+            return {name: round(value, 6) if isinstance(value, float) else value for name, value in values.items()}
+
+        with self._lock:
+            counters = rounded(self.counters)
+            phases = rounded(self.phases)
+            targets = {name: rounded(values) for name, values in self.targets.items()}
+            subdirs = {name: rounded(values) for name, values in self.subdirs.items()}
+        copy_seconds = self.phases.get('copy', 0.0)
+        bytes_copied = counters.get('bytes_copied', 0)
+        return {
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'elapsed_s': round(time.time() - self.started, 6),
+            'phases': phases,
+            'counters': counters,
+            'copy_mb_per_s': round(bytes_copied / copy_seconds / (1024 * 1024), 1) if copy_seconds > 0 else None,
+            'targets': targets,
+            'subdirs': subdirs,
+        }
+
+    def print_summary(self):
+        report = self.report()
+        counters = report['counters']
+        print("\n运行统计:")
+        print("  阶段耗时: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in report['phases'].items()))
+        print(f"  扫描: {counters.get('dirs_scanned', 0)} 个目录, {counters.get('files_scanned', 0)} 个文件, "
+              f"stat {counters.get('stat_calls', 0)} 次")
+        copy_line = (f"  复制: {counters.get('files_copied', 0)} 个文件, "
+                     f"{format_size(counters.get('bytes_copied', 0))}")
+        if report['copy_mb_per_s'] is not None:
+            copy_line += f", {report['copy_mb_per_s']} MB/s"
+        if counters.get('copy_errors'):
+            copy_line += f", 失败 {counters['copy_errors']} 个"
+        print(copy_line)
+        print(f"  替换 {counters.get('files_replaced', 0)} 个, 跳过 {counters.get('files_skipped', 0)} 个, "
+              f"删除旧文件 {counters.get('files_deleted', 0)} 个（释放 {format_size(counters.get('bytes_freed', 0))}）")
+        if counters.get('prompt_wait_s'):
+            print(f"  等待确认: {counters['prompt_wait_s']:.1f}s")
+        if counters.get('throttle_wait_s'):
+            print(f"  限速等待: {counters['throttle_wait_s']:.1f}s")
+
+    def save(self, path):
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.report(), f, ensure_ascii=False, indent=2)
+            print(f"运行报告已保存: {path}")
+        except OSError as e:
+            print(f"保存运行报告失败 {path}: {str(e)}")
+
+
+_run_metrics = RunMetrics()
+
+
+def get_metrics():
+    """返回进程内共享的运行指标"""
+    return _run_metrics
+
+
+# 版本号：数字.数字[.数字...]，可带 v 前缀（如 2025.1.3、1.2、v1.2.3）
+VERSION_PATTERN = re.compile(r'v?(\d+(?:\.\d+)+)', re.IGNORECASE)
+VERSION_CACHE_SIZE = 8192
+
+# 最新文件的选择策略
+SELECT_POLICIES = ('mtime', 'version', 'both')
+DEFAULT_SELECT_POLICY = 'mtime'
+
+
+@functools.lru_cache(maxsize=VERSION_CACHE_SIZE)
+def parse_version(filename):
+    """
+    从文件名（不含扩展名）中解析版本号，返回可比较的整数元组，没有版本号时返回 None
+    文件名中有多个版本号时取段数最多的一个（段数相同取第一个）；末尾的 .0 不影响比较（1.2 == 1.2.0）
+    例：Neptune_2025.1.3.exe -> (2025, 1, 3)
+    """
+    name_without_ext = os.path.splitext(filename)[0]
+    best = None
+    for match in VERSION_PATTERN.finditer(name_without_ext):
+        parts = tuple(int(p) for p in match.group(1).split('.'))
+        if best is None or len(parts) > len(best):
+            best = parts
+    if best is None:
+        return None
+    while len(best) > 1 and best[-1] == 0:
+        best = best[:-1]
+    return best
 
 
 def has_version_number(filename):
@@ -237,55 +476,276 @@ def has_version_number(filename):
     - v数字.数字.数字 (如: v1.2.3)
     - 下划线或连字符分隔 (如: Neptune_2025.1.3.exe, App-1.2.3.exe)
     """
-    # 移除文件扩展名，只检查文件名部分
-    name_without_ext = os.path.splitext(filename)[0]
-    
-    # 版本号模式：匹配数字.数字.数字 或 数字.数字
-    # 支持前面有下划线、连字符或v前缀
-    version_patterns = [
-        r'\d+\.\d+\.\d+',  # 三段式：2025.1.3, 1.2.3
-        r'\d+\.\d+',        # 两段式：1.2
-        r'v\d+\.\d+\.\d+',  # 带v前缀：v1.2.3
-        r'v\d+\.\d+',       # 带v前缀两段：v1.2
-    ]
-    
-    for pattern in version_patterns:
-        if re.search(pattern, name_without_ext):
-            return True
-    
-    return False
+    return parse_version(filename) is not None
+
+
+def _selection_key(policy, version, mtime_ns):
+    if policy == 'version':
+        return version
+    if policy == 'both':
+        return (version, mtime_ns)
+    return mtime_ns
+
+
+# 扫描得到的单个文件：path 为完整路径，name 为文件名，stat 为扫描时取得的 os.stat_result
+# 后续的复制、日志步骤直接复用 stat，不再重复 getmtime
+LatestFile = namedtuple('LatestFile', ['path', 'name', 'stat'])
+
+
+def scan_latest_entries(source_dir, policy=DEFAULT_SELECT_POLICY):
+    """
+    使用 os.scandir 单次遍历目录，选出最新版本的文件（只包含有版本号的文件）
+    policy 决定"最新"的含义：
+    - mtime：修改时间最新（默认）
+    - version：文件名中的版本号最大（不受同步工具改写修改时间的影响）
+    - both：先比较版本号，版本号相同时再比较修改时间
+    流式比较，只保留当前最新的那一组，不做整体排序
+    返回 LatestFile 列表（可能有多个文件并列最新，如同一版本的 exe 和 zip）
+    """
+    return _scan_dir(source_dir, policy)[0]
+
+
+def _scan_dir(source_dir, policy=DEFAULT_SELECT_POLICY, subdir=None):
+    """
+    scan_latest_entries 的实现，同一次 scandir 中顺便收集子目录名（供递归遍历使用）
+    subdir: 相对源目录的路径，扫描计数和耗时（scan_s）同时按该子目录汇总
+    返回 (LatestFile 列表, 子目录名列表)；目录无法读取时两者都为空
+    """
+    start = time.perf_counter()
+    latest_entries = []
+    latest_key = None
+    subdir_names = []
+    files_scanned = 0
+    stat_calls = 0
+
+    try:
+        it = os.scandir(source_dir)
+    except OSError:
+        return latest_entries, subdir_names
+
+    with it:
+        for entry in it:
+            files_scanned += 1
+            # 只选择包含版本号的文件；先做文件名判断，避免对无关文件取 stat
+            version = parse_version(entry.name)
+            if version is None:
+                try:
+                    if entry.is_dir():
+                        subdir_names.append(entry.name)
+                except OSError:
+                    pass
+                continue
+            try:
+                if not entry.is_file():
+                    if entry.is_dir():
+                        subdir_names.append(entry.name)
+                    continue
+                stat_calls += 1
+                st = entry.stat()
+            except OSError:
+                continue
+
+            key = _selection_key(policy, version, st.st_mtime_ns)
+            if latest_key is None or key > latest_key:
+                latest_key = key
+                latest_entries = [LatestFile(entry.path, entry.name, st)]
+            elif key == latest_key:
+                latest_entries.append(LatestFile(entry.path, entry.name, st))
+
+    metrics = get_metrics()
+    metrics.add('dirs_scanned', subdir=subdir)
+    metrics.add('files_scanned', files_scanned, subdir=subdir)
+    metrics.add('stat_calls', stat_calls, subdir=subdir)
+    metrics.add('scan_s', time.perf_counter() - start, subdir=subdir)
+    return latest_entries, subdir_names
 
 
 def get_latest_files_in_dir(source_dir):
     """
     获取目录中最新版本的文件（只包含有版本号的文件）
-    返回修改时间最新的文件列表
-    """
-    files = []
-    if not os.path.exists(source_dir):
-        return files
-    
-    for item in os.listdir(source_dir):
-        item_path = os.path.join(source_dir, item)
-        if os.path.isfile(item_path):
-            # 只选择包含版本号的文件
-            if has_version_number(item):
-                files.append(item_path)
-    
-    if not files:
+    返回修改时间最新的文件路径列表
+    """
+    return [f.path for f in scan_latest_entries(source_dir)]
+
+
+# 最新文件计划：一次扫描源目录得到的只读结果，可供多个目标目录复用
+# entries 中每一项对应源目录下的一个子目录，subdir_name 为相对源目录的路径（多级时用 / 分隔），
+# files 为该子目录中最新版本文件（LatestFile）的元组
+LatestPlan = namedtuple('LatestPlan', ['source_dir', 'entries'])
+PlanEntry = namedtuple('PlanEntry', ['subdir_name', 'files'])
+
+DEFAULT_SCAN_DEPTH = 1    # 只处理源目录下的第一级子目录（原有行为）
+DEFAULT_SCAN_WORKERS = 1  # 串行扫描；源目录在高延迟网络共享上时可调大
+SCAN_PREFETCH_FACTOR = 4  # 并发扫描时每个线程最多预取的目录数
+
+
+def _match_dir(rel_path, patterns):
+    """不含 / 的模式匹配目录名，含 / 的模式匹配完整相对路径"""
+    name = rel_path.rsplit('/', 1)[-1]
+    for pattern in patterns:
+        target = rel_path if '/' in pattern else name
+        if fnmatch.fnmatchcase(target, pattern):
+            return True
+    return False
+
+
+def _list_child_dirs(path):
+    try:
+        it = os.scandir(path)
+    except OSError:
         return []
-    
-    # 按修改时间排序，获取最新修改的文件时间
-    files_with_time = [(f, os.path.getmtime(f)) for f in files]
-    files_with_time.sort(key=lambda x: x[1], reverse=True)
-    
-    # 获取最新修改时间
-    latest_time = files_with_time[0][1]
-    
-    # 返回所有具有最新修改时间的文件（可能有多个文件在同一时间修改）
-    latest_files = [f for f, t in files_with_time if t == latest_time]
-    
-    return latest_files
+    names = []
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    names.append(entry.name)
+            except OSError:
+                continue
+    return names
+
+
+def walk_latest_groups(source_dir, max_depth=DEFAULT_SCAN_DEPTH, include=None, exclude=None,
+                       policy=DEFAULT_SELECT_POLICY, roots=None, workers=DEFAULT_SCAN_WORKERS):
+    """
+    递归遍历源目录，逐个目录产出 PlanEntry(相对路径, 最新文件元组)
+    - max_depth：向下遍历的层数，1 表示只看第一级子目录；0 表示不限
+    - include：目录匹配任一模式时才产出（不影响继续向下遍历）
+    - exclude：目录匹配任一模式时跳过它及其所有下级目录
+    - roots：只遍历这些第一级子目录（监视模式用）
+    - workers：并发扫描的线程数。大于 1 时用线程池提前扫描即将访问的目录（网络共享上每次
+      listdir/stat 都有往返延迟），产出顺序和内容与串行扫描完全一致
+    生成器按深度优先、同级按名称排序产出，每个目录扫描完立即产出，调用方可以边扫描边复制；
+    只保留待访问目录的栈和当前目录的最新文件组，内存占用与文件总数无关
+    （并发时最多预取 workers * SCAN_PREFETCH_FACTOR 个目录的结果）
+    只含下级目录、自身没有版本文件的中间目录不产出；没有下级目录的目录即使没有版本文件也会产出，
+    便于日志提示
+    """
+    include = list(include or [])
+    exclude = list(exclude or [])
+
+    top = _list_child_dirs(source_dir)
+    if roots is not None:
+        wanted = set(roots)
+        top = [name for name in top if name in wanted]
+
+    # 栈中每项为 [路径, 相对路径, 层级, 扫描结果的 future]；栈顶（列表末尾）是下一个要访问的目录
+    stack = [[os.path.join(str(source_dir), name), name, 1, None]
+             for name in sorted(top, reverse=True) if not (exclude and _match_dir(name, exclude))]
+
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    window = workers * SCAN_PREFETCH_FACTOR
+    try:
+        while stack:
+            if executor is not None:
+                # 为栈顶附近即将访问的目录提前提交扫描任务
+                for node in stack[-window:]:
+                    if node[3] is None:
+                        node[3] = executor.submit(_scan_dir, node[0], policy, node[1])
+
+            path, rel, depth, future = stack.pop()
+            with get_metrics().phase('scan'):
+                files, children = future.result() if future is not None else _scan_dir(path, policy, rel)
+            descend = max_depth == 0 or depth < max_depth
+            children = sorted(children) if descend else []
+
+            if (files or not children) and (not include or _match_dir(rel, include)):
+                yield PlanEntry(rel, tuple(files))
+
+            for name in reversed(children):
+                child_rel = f"{rel}/{name}"
+                if exclude and _match_dir(child_rel, exclude):
+                    continue
+                stack.append([os.path.join(path, name), child_rel, depth + 1, None])
+    finally:
+        if executor is not None:
+            # 提前结束遍历时不等待尚未开始的扫描
+            for node in stack:
+                if node[3] is not None:
+                    node[3].cancel()
+            executor.shutdown(wait=True)
+
+
+def build_latest_plan(source_dir, policy=DEFAULT_SELECT_POLICY, max_depth=DEFAULT_SCAN_DEPTH,
+                      include=None, exclude=None, workers=DEFAULT_SCAN_WORKERS):
+    """
+    扫描源目录一次，构建"最新文件计划"
+    policy: 最新文件的选择策略，见 scan_latest_entries
+    max_depth/include/exclude/workers: 遍历参数，见 walk_latest_groups
+    返回 LatestPlan；源目录不存在时返回 None
+    计划内容不可变（namedtuple + tuple），可以安全地分发给所有目标目录
+    """
+    if not os.path.isdir(source_dir):
+        return None
+    entries = walk_latest_groups(source_dir, max_depth, include, exclude, policy, workers=workers)
+    return LatestPlan(str(source_dir), tuple(entries))
+
+
+def format_size(num_bytes):
+    """把字节数格式化为便于阅读的字符串，如 1.5 GB"""
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+# 目标文件已存在时的处理策略
+CONFLICT_POLICIES = ('ask', 'overwrite', 'skip', 'newer-only', 'size-or-mtime-differs')
+DEFAULT_CONFLICT_POLICY = 'ask'
+# 无人值守（非交互终端、--headless、监视模式）时 ask 改用的策略
+HEADLESS_CONFLICT_POLICY = 'size-or-mtime-differs'
+
+
+def should_replace(policy, latest_file, target_file):
+    """
+    按策略决定是否替换已存在的目标文件
+    - ask：交互式询问（见 ask_replace_file）
+    - overwrite：总是替换
+    - skip：总是跳过
+    - newer-only：源文件修改时间比目标文件新时替换
+    - size-or-mtime-differs：大小或修改时间不同时替换
+    """
+    if policy == 'overwrite':
+        return True
+    if policy == 'skip':
+        return False
+    if policy in ('newer-only', 'size-or-mtime-differs'):
+        try:
+            dst_st = os.stat(target_file)
+        except OSError:
+            return True
+        src_st = latest_file.stat
+        if policy == 'newer-only':
+            return src_st.st_mtime_ns > dst_st.st_mtime_ns
+        return src_st.st_size != dst_st.st_size or src_st.st_mtime_ns != dst_st.st_mtime_ns
+    return ask_replace_file(latest_file.name)
+
+
+def is_headless():
+    """标准输入不是交互终端（计划任务、重定向等）时无法询问"""
+    try:
+        return sys.stdin is None or not sys.stdin.isatty()
+    except (AttributeError, ValueError):
+        return True
+
+
+def apply_conflict_policy(target_configs, default_policy=DEFAULT_CONFLICT_POLICY, headless=False):
+    """
+    为每个目标目录确定冲突策略：目标目录自己的 --conflict 优先，否则使用 default_policy
+    headless 为 True 时把 ask 换成 HEADLESS_CONFLICT_POLICY，保证运行过程中不会阻塞等待按键
+    返回新的 [(目标目录, 配置字典)]，不修改传入的配置
+    """
+    resolved = []
+    for td, cfg in target_configs:
+        cfg = dict(cfg)
+        policy = cfg.get('conflict', default_policy)
+        if headless and policy == 'ask':
+            policy = HEADLESS_CONFLICT_POLICY
+        cfg['conflict'] = policy
+        resolved.append((td, cfg))
+    return resolved
 
 
 def ask_replace_file(file_name):
@@ -361,133 +821,2152 @@ def ask_replace_file(file_name):
         return True
 
 
-def clean_old_files(target_subdir, latest_file_names):
+# 内容摘要
+HASH_ALGORITHMS = ('blake2b', 'sha256')
+DEFAULT_HASH_ALGORITHM = 'blake2b'
+HASH_CHUNK_SIZE = 8 * 1024 * 1024      # 大块读取；hashlib 处理超过 2KB 的数据时会释放 GIL
+DEFAULT_HASH_WORKERS = 4
+DIGEST_CACHE_MAX_ENTRIES = 20000
+DIGEST_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.copy4bk', 'digest-cache.json')
+
+
+class DigestCache:
     """
-    清理目标子目录中的旧文件，只保留最新的文件
-    latest_file_names: 最新文件的文件名列表
+    持久化的摘要缓存，键为 (算法, 设备号, inode, 大小, st_mtime_ns)
+    文件内容变化必然改变大小或修改时间，命中缓存即可跳过重新计算
+    超过 max_entries 时按最近最少使用淘汰
     """
-    if not target_subdir.exists() or not target_subdir.is_dir():
-        return
-    
-    deleted_count = 0
-    for file_path in target_subdir.iterdir():
-        if file_path.is_file():
-            file_name = file_path.name
-            # 如果该文件不在最新文件列表中，删除它
-            if file_name not in latest_file_names:
-                try:
-                    file_path.unlink()
-                    deleted_count += 1
-                    print(f"  已删除旧文件: {file_name}")
-                except Exception as e:
-                    print(f"  删除旧文件失败 {file_name}: {str(e)}")
-    
-    if deleted_count > 0:
-        print(f"  共删除 {deleted_count} 个旧文件")
+
+    def __init__(self, path=None, max_entries=DIGEST_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        if path:
+            self._load()
+
+    @staticmethod
+    def make_key(algorithm, st):
+        return f"{algorithm}:{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def get(self, key):
+        with self._lock:
+            digest = self._entries.get(key)
+            if digest is not None:
+                self._entries.move_to_end(key)
+            return digest
+
+    def put(self, key, digest):
+        with self._lock:
+            self._entries[key] = digest
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # 文件中按从旧到新的顺序保存，载入后保持 LRU 顺序
+            for key, digest in data.get('entries', []):
+                self._entries[key] = digest
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        except (OSError, ValueError, TypeError, AttributeError):
+            self._entries.clear()
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            data = {'entries': list(self._entries.items())}
+            self._dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"保存摘要缓存失败 {self.path}: {str(e)}")
+
+
+_default_digest_cache = None
+_default_digest_cache_lock = threading.Lock()
+
+
+def get_digest_cache():
+    """返回进程内共享的持久化摘要缓存（首次调用时从 DIGEST_CACHE_PATH 载入）"""
+    global _default_digest_cache
+    with _default_digest_cache_lock:
+        if _default_digest_cache is None:
+            _default_digest_cache = DigestCache(DIGEST_CACHE_PATH)
+        return _default_digest_cache
 
 
-def copy_latest_files(source_dir, target_dir, config=None):
+def file_digest(path, algorithm=DEFAULT_HASH_ALGORITHM, cache=None):
     """
-    将源目录下每个子目录中的最新版本文件复制到目标目录的对应子目录中
-    config: 目标目录的配置字典，包含 clean_old 等选项
+    分块计算文件内容摘要（十六进制字符串），结果写入缓存
+    缓存键必须来自 os.stat：Windows 上 os.scandir 的 DirEntry.stat() 中 st_dev/st_ino 恒为 0，
+    用它作键既会与计算后的校验不一致（永远不写入缓存），也会让不同文件共用一个键
     """
-    if config is None:
-        config = {}
-    
-    source_path = Path(source_dir)
-    target_path = Path(target_dir)
-    
-    if not source_path.exists():
-        print(f"源目录不存在: {source_dir}")
-        return
-    
-    # 创建目标目录（如果不存在）
-    target_path.mkdir(parents=True, exist_ok=True)
-    
-    clean_old = config.get('clean_old', False)  # 默认不清理旧文件
-    
-    # 遍历源目录下的每个子目录
-    for subdir in source_path.iterdir():
-        if subdir.is_dir():
-            subdir_name = subdir.name
-            print(f"\n处理子目录: {subdir_name}")
-            
-            # 获取该子目录中的最新文件
-            latest_files = get_latest_files_in_dir(str(subdir))
-            
-            if not latest_files:
-                print(f"  子目录 {subdir_name} 中没有找到包含版本号的文件")
-                continue
-            
-            # 创建目标子目录
-            target_subdir = target_path / subdir_name
-            target_subdir.mkdir(parents=True, exist_ok=True)
-            
-            # 获取最新文件的文件名列表（用于清理旧文件）
-            latest_file_names = [os.path.basename(f) for f in latest_files]
-            
-            # 如果启用了清理旧文件功能，先清理旧文件
-            if clean_old:
-                clean_old_files(target_subdir, latest_file_names)
-            
-            # 复制最新文件到目标子目录
-            for file_path in latest_files:
-                file_name = os.path.basename(file_path)
-                target_file = target_subdir / file_name
-                
-                # 检查目标文件是否已存在
-                file_exists = target_file.exists()
-                
-                if file_exists:
-                    # 询问是否替换
-                    if not ask_replace_file(file_name):
-                        print(f"  已跳过: {file_name}")
-                        continue
-                
-                try:
-                    shutil.copy2(file_path, target_file)
-                    mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-                    action = "已替换" if file_exists else "已复制"
-                    print(f"  {action}: {file_name} (修改时间: {mod_time.strftime('%Y-%m-%d %H:%M:%S')})")
-                except Exception as e:
-                    print(f"  复制失败 {file_name}: {str(e)}")
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"不支持的摘要算法: {algorithm}")
+    st = os.stat(path)
+    key = DigestCache.make_key(algorithm, st)
+    if cache is not None:
+        digest = cache.get(key)
+        if digest is not None:
+            return digest
 
+    h = hashlib.new(algorithm)
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    digest = h.hexdigest()
 
-if __name__ == '__main__':
-    def wait_for_keypress():
+    # 计算期间文件被改写则不缓存
+    if cache is not None:
         try:
-            if msvcrt is not None:
-                print("\n按任意键退出...")
-                msvcrt.getch()
-                return
-            # 非 Windows 兜底
-            input("\n按回车键退出...")
-        except Exception:
-            pass
+            after = os.stat(path)
+        except OSError:
+            after = None
+        if after is not None and DigestCache.make_key(algorithm, after) == key:
+            cache.put(key, digest)
+    return digest
 
+
+def hash_files(paths, algorithm=DEFAULT_HASH_ALGORITHM, cache=None, max_workers=DEFAULT_HASH_WORKERS):
+    """
+    在线程池中并发计算多个文件的摘要，返回 {路径: 摘要}；计算失败的文件不出现在结果中
+    """
+    paths = list(paths)
+    results = {}
+    if not paths:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as executor:
+        futures = [(p, executor.submit(file_digest, p, algorithm, cache)) for p in paths]
+        for p, future in futures:
+            try:
+                results[p] = future.result()
+            except (OSError, ValueError):
+                pass
+    return results
+
+
+def files_identical(path_a, path_b, algorithm=DEFAULT_HASH_ALGORITHM, cache=None):
+    """
+    判断两个文件内容是否相同
+    先比较大小和 (设备号, inode)，只有大小相同且不是同一个文件时才计算摘要（两边并发，优先走缓存）
+    """
     try:
-        print_intro()
-        # 从配置文件读取源目录和目标目录们
-        source_directory, target_directories = read_config('copy4bk-win.txt')
+        st_a = os.stat(path_a)
+        st_b = os.stat(path_b)
+    except OSError:
+        return False
+    if st_a.st_size != st_b.st_size:
+        return False
+    if (st_a.st_dev, st_a.st_ino) == (st_b.st_dev, st_b.st_ino):
+        return True
+    digests = hash_files([path_a, path_b], algorithm, cache, max_workers=2)
+    return (len(digests) == 2) and digests[path_a] == digests[path_b]
+
+
+# 旧文件清理
+DEFAULT_DELETE_WORKERS = 8
+DELETE_BATCH_SIZE = 32
+_SIZE_UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2,
+               'G': 1024 ** 3, 'GB': 1024 ** 3, 'T': 1024 ** 4, 'TB': 1024 ** 4}
+
+
+def parse_size(text):
+    """解析 20G、500MB、1024 这样的大小写法，返回字节数；格式不对时抛出 ValueError"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*$', str(text))
+    if not match or match.group(2).upper() not in _SIZE_UNITS:
+        raise ValueError(f"无效的大小: {text}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def _is_internal_file(name):
+    """本工具自己的临时文件（如 .xxx.copy4bk-delta），不参与清理"""
+    return name.startswith('.') and '.copy4bk-' in name
 
-        if not source_directory or not target_directories:
-            print("错误：无法从配置文件读取源目录或目标目录！")
-            print("\n请确保配置文件 copy4bk-win.txt 存在且格式正确。")
-        else:
-            print("开始复制最新版本文件...")
-            print(f"源目录: {source_directory}")
-            print("目标目录配置:")
-            for idx, (td, cfg) in enumerate(target_directories, 1):
-                clean_old_status = "启用" if cfg.get('clean_old', False) else "禁用"
-                print(f"  {idx}. {td} (清理旧文件: {clean_old_status})")
 
-            for td, cfg in target_directories:
-                print(f"\n=> 正在处理目标目录: {td}")
-                clean_old_status = "启用" if cfg.get('clean_old', False) else "禁用"
-                if clean_old_status == "启用":
-                    print(f"  清理旧文件功能: {clean_old_status}")
-                copy_latest_files(source_directory, td, cfg)
+def retention_enabled(config):
+    return bool(config.get('clean_old', False) or config.get('keep') or config.get('max_bytes'))
 
-            print("\n全部目标目录处理完成！")
+
+def retention_keep(config):
+    """
+    每个子目录保留的版本数（含最新版本），None 表示不限
+    只设置了 max_bytes（没有 keep、clean_old）时不按版本数删除，只在超过总大小上限时删除最旧的版本
+    """
+    if config.get('keep'):
+        return config['keep']
+    if config.get('max_bytes') is not None and not config.get('clean_old', False):
+        return None
+    return 1
+
+
+def _split_groups(groups, keep):
+    """按 keep 把旧版本组（从新到旧）分为 (保留, 删除)；keep 为 None 时全部保留"""
+    if keep is None:
+        return list(groups), []
+    return list(groups[:max(0, keep - 1)]), list(groups[max(0, keep - 1):])
+
+
+def _scan_retention(target_subdir, latest_file_names):
+    """
+    使用 os.scandir 一次遍历目标子目录，为保留规则收集信息
+    返回 (最新文件总大小, 旧版本组列表, 不带版本号的文件列表)
+    旧版本组按从新到旧排列，每组为 (版本号, 组内最新修改时间, [(路径, 大小)])；版本号相同按修改时间
+    """
+    latest_names = set(latest_file_names)
+    latest_bytes = 0
+    versions = {}
+    unversioned = []
+
+    try:
+        it = os.scandir(target_subdir)
+    except OSError:
+        return 0, [], []
+    with it:
+        for entry in it:
+            if _is_internal_file(entry.name):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            if entry.name in latest_names:
+                latest_bytes += st.st_size
+                continue
+            version = parse_version(entry.name)
+            if version is None:
+                unversioned.append((entry.path, st.st_size))
+            else:
+                versions.setdefault(version, []).append((entry.path, st.st_size, st.st_mtime_ns))
+
+    groups = [(version, max(f[2] for f in files), [(f[0], f[1]) for f in files])
+              for version, files in versions.items()]
+    groups.sort(key=lambda g: (g[0], g[1]), reverse=True)
+    return latest_bytes, groups, unversioned
+
+
+def _group_bytes(group):
+    return sum(size for _, size in group[2])
+
+
+def plan_retention(target_subdir, latest_file_names, keep=1, max_bytes=None, delete_unversioned=True):
+    """
+    按保留规则计算一个目标子目录中需要删除的文件，不做任何删除
+    - 最新文件（latest_file_names）总是保留
+    - 带版本号的旧文件按版本号从新到旧排序，连同最新文件一共保留 keep 个版本（None 表示不限）
+    - max_bytes：保留的文件总大小超过上限时，从最旧的版本开始继续删除（最新文件除外）
+    - delete_unversioned：是否删除不带版本号的文件（clean_old 的原有行为）
+    返回 [(文件路径, 大小)]
+    """
+    latest_bytes, groups, unversioned = _scan_retention(target_subdir, latest_file_names)
+    kept, removed = _split_groups(groups, keep)
+
+    if max_bytes is not None:
+        total = latest_bytes + sum(_group_bytes(g) for g in kept)
+        while kept and total > max_bytes:
+            group = kept.pop()
+            total -= _group_bytes(group)
+            removed.append(group)
+
+    result = list(unversioned) if delete_unversioned else []
+    for group in removed:
+        result.extend(group[2])
+    return result
+
+
+def delete_files(files, max_workers=DEFAULT_DELETE_WORKERS, batch_size=DELETE_BATCH_SIZE):
+    """
+    分批并发删除文件（网络盘、同步盘上逐个删除很慢）
+    files: [(文件路径, 大小)]
+    返回 (成功删除的数量, 释放的字节数, [(文件路径, 错误)])
+    """
+    def delete_batch(batch):
+        done, freed, failed = 0, 0, []
+        for path, size in batch:
+            try:
+                os.unlink(path)
+                done += 1
+                freed += size
+            except OSError as e:
+                failed.append((path, e))
+        return done, freed, failed
+
+    files = list(files)
+    if not files:
+        return 0, 0, []
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    deleted, freed, failures = 0, 0, []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+        for done, batch_freed, failed in executor.map(delete_batch, batches):
+            deleted += done
+            freed += batch_freed
+            failures.extend(failed)
+    return deleted, freed, failures
+
+
+def _record_deletions(candidates, failures, target_dir=None):
+    """按目标目录、子目录（相对目标目录的路径）累计删除的文件数和释放的字节数"""
+    metrics = get_metrics()
+    failed_paths = {path for path, _ in failures}
+    for path, size in candidates:
+        subdir = None
+        if target_dir is not None:
+            subdir = os.path.relpath(os.path.dirname(path), str(target_dir)).replace(os.sep, '/')
+        if path in failed_paths:
+            metrics.add('delete_errors', target=target_dir, subdir=subdir)
+            continue
+        metrics.add('files_deleted', target=target_dir, subdir=subdir)
+        metrics.add('bytes_freed', size, target=target_dir, subdir=subdir)
+
+
+def clean_old_files(target_subdir, latest_file_names, dry_run=False, keep=1, max_bytes=None):
+    """
+    清理目标子目录中的旧文件，只保留最新的文件（以及 keep、max_bytes 允许保留的旧版本）
+    latest_file_names: 最新文件的文件名列表
+    dry_run: 为 True 时只列出将要删除的文件，不删除
+    返回 [(文件路径, 大小)]：已删除（或将要删除）的文件
+    """
+    candidates = plan_retention(target_subdir, latest_file_names, keep, max_bytes)
+    if dry_run:
+        for path, size in candidates:
+            print(f"  [将删除] {os.path.basename(path)} ({format_size(size)})")
+        return candidates
+
+    deleted, freed, failures = delete_files(candidates)
+    for path, e in failures:
+        print(f"  删除旧文件失败 {os.path.basename(path)}: {str(e)}")
+    _record_deletions(candidates, failures)
+    if deleted > 0:
+        print(f"  共删除 {deleted} 个旧文件，释放 {format_size(freed)}")
+    failed_paths = {path for path, _ in failures}
+    return [(path, size) for path, size in candidates if path not in failed_paths]
+
+
+def apply_retention(plan, target_dir, config, failed_subdirs=(), dry_run=False):
+    """
+    复制完成后按保留规则清理一个目标目录：所有子目录的待删除文件汇总后一起分批并发删除
+    keep 按子目录生效；max_bytes 是整个目标目录的上限，超出时在所有子目录中按修改时间从最旧的旧版本删起
+    failed_subdirs: 本次有文件复制失败的子目录名，这些子目录不清理，避免目标目录里一个可用版本都没有
+    返回 [(文件路径, 大小)]：已删除（或将要删除）的文件
+    """
+    keep = retention_keep(config)
+    max_bytes = config.get('max_bytes')
+    delete_unversioned = config.get('clean_old', False)
+
+    candidates = []
+    kept_groups = []
+    total = 0
+    skipped = []
+    for entry in plan.entries:
+        if not entry.files:
+            continue
+        if entry.subdir_name in failed_subdirs:
+            skipped.append(entry.subdir_name)
+            continue
+        target_subdir = os.path.join(str(target_dir), entry.subdir_name)
+        latest_bytes, groups, unversioned = _scan_retention(target_subdir, [f.name for f in entry.files])
+        if delete_unversioned:
+            candidates.extend(unversioned)
+        kept, removed = _split_groups(groups, keep)
+        for group in removed:
+            candidates.extend(group[2])
+        kept_groups.extend(kept)
+        total += latest_bytes + sum(_group_bytes(g) for g in kept)
+
+    if max_bytes is not None and total > max_bytes:
+        # 跨子目录按修改时间从旧到新继续删除保留下来的旧版本
+        for group in sorted(kept_groups, key=lambda g: g[1]):
+            if total <= max_bytes:
+                break
+            candidates.extend(group[2])
+            total -= _group_bytes(group)
+        if total > max_bytes:
+            print(f"  注意: 仅最新版本已占用 {format_size(total)}，超过上限 {format_size(max_bytes)}")
+
+    if skipped:
+        print(f"  以下子目录有文件复制失败，本次不清理: {', '.join(skipped)}")
+    if dry_run:
+        for path, size in candidates:
+            print(f"  [将删除] {os.path.relpath(path, str(target_dir))} ({format_size(size)})")
+        return candidates
+
+    deleted, freed, failures = delete_files(candidates)
+    for path, e in failures:
+        print(f"  删除旧文件失败 {os.path.relpath(path, str(target_dir))}: {str(e)}")
+    _record_deletions(candidates, failures, target_dir)
+    if candidates:
+        print(f"  清理旧文件: 删除 {deleted} 个，释放 {format_size(freed)}"
+              + (f"，失败 {len(failures)} 个" if failures else ""))
+    failed_paths = {path for path, _ in failures}
+    return [(path, size) for path, size in candidates if path not in failed_paths]
+
+
+# 并发复制的默认参数
+DEFAULT_MAX_WORKERS = 8         # 线程池大小（所有目标目录共用）
+DEFAULT_TARGET_CONCURRENCY = 2  # 每个目标目录同时进行的复制任务数
+DEFAULT_DEVICE_CONCURRENCY = 2  # 每个物理设备（st_dev）同时进行的复制任务数
+
+TEE_CHUNK_SIZE = 1024 * 1024   # 扇出复制时每次从源文件读取的字节数
+DELTA_BLOCK_SIZE = 128 * 1024  # 增量复制的块大小
+DELTA_SEARCH_WINDOW = 1024 * 1024  # 块未命中时，在基准文件中预期位置前后这么大的范围内重新对齐
+DELTA_PROBE_SIZE = 64              # 重新对齐时先用块开头这么多字节在窗口中查找候选位置
+DELTA_PROBE_CHECKS = 16            # 每个块最多逐一比对这么多个候选位置
+DELTA_RESYNC_LIMIT = 8             # 连续这么多个块重新对齐失败后不再查找，直到再次命中
+
+# 内核加速复制后端，按顺序尝试
+COPY_BACKENDS = ('reflink', 'copy_file_range', 'sendfile', 'buffered')
+FICLONE = 0x40049409                 # linux/fs.h: _IOW(0x94, 9, int)
+BUFFERED_CHUNK_SIZE = 4 * 1024 * 1024  # 用户态复制循环的缓冲区大小
+KERNEL_CHUNK_SIZE = 64 * 1024 * 1024   # copy_file_range/sendfile 单次调用的最大字节数
+
+# 表示"当前文件系统不支持该后端"的 errno，遇到时换下一个后端并记住结果
+_UNSUPPORTED_ERRNOS = {
+    getattr(errno, name) for name in ('EOPNOTSUPP', 'ENOTSUP', 'EXDEV', 'EINVAL', 'ENOSYS', 'ENOTTY', 'EBADF')
+    if hasattr(errno, name)
+}
+
+# 暂存与断点续传：新文件先写入目标子目录中的 .文件名.copy4bk-part，完成后原子替换为正式文件名
+RESUME_MIN_SIZE = 64 * 1024 * 1024          # 不小于该大小的文件记录进度，中断后可续传
+RESUME_CHECKPOINT_SIZE = 256 * 1024 * 1024  # 每复制这么多字节 fsync 一次并更新进度文件（中断最多重传这么多）
+RESUME_VERIFY_SIZE = 8 * 1024 * 1024        # 续传前与源文件比对的块大小
+RESUME_VERSION = 2
+
+# 能力缓存：{(源设备号, 目标设备号): 第一个可用后端在 COPY_BACKENDS 中的下标}
+_backend_cache = {}
+_backend_cache_lock = threading.Lock()
+
+# I/O 调度：限速、优先级、在途字节上限
+THROTTLE_CHUNK_SIZE = 1024 * 1024  # 限速时每次读写/内核复制的字节数，块越小速率越平稳
+COPY_PRIORITIES = ('small-first', 'plan')
+DEFAULT_COPY_PRIORITY = 'small-first'  # 小文件先复制，大安装包最后
+
+
+class TokenBucket:
+    """
+    令牌桶限速：每秒补充 rate 个字节的令牌，最多积累 burst 个
+    consume 允许透支（单次可以超过 burst），透支的部分按速率睡眠补齐，可在多个线程中同时调用
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, THROTTLE_CHUNK_SIZE))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        """取出 n 个字节的令牌，返回为此等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Throttle:
+    """
+    一个目标目录的写入限速：依次经过该目标目录自己的令牌桶和全局令牌桶
+    per_target 为 True 表示该目标目录有自己的限速（此时不参与扇出复制，见 run_copy_jobs）
+    """
+
+    def __init__(self, buckets, target=None, per_target=False):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+        self.target = target
+        self.per_target = per_target
+
+    def consume(self, n):
+        waited = sum(bucket.consume(n) for bucket in self.buckets)
+        if waited:
+            get_metrics().add('throttle_wait_s', waited, target=self.target)
+
+
+def make_throttles(target_configs, global_rate=None):
+    """
+    按目标目录的 throttle 选项（字节/秒）和全局限速 global_rate 创建限速器
+    返回 {目标目录: Throttle}，不限速的目标目录不出现在结果中
+    分批复制、监视模式应只创建一次并重复使用，令牌桶才能跨批次生效
+    """
+    global_bucket = TokenBucket(global_rate) if global_rate else None
+    throttles = {}
+    for td, cfg in target_configs:
+        rate = cfg.get('throttle')
+        buckets = [TokenBucket(rate) if rate else None, global_bucket]
+        if any(buckets):
+            throttles[str(td)] = Throttle(buckets, str(td), per_target=bool(rate))
+    return throttles
+
+
+class ByteBudget:
+    """
+    在途字节上限：同时复制的文件总大小不超过 limit
+    单个文件超过上限时等其他文件都完成后独自复制，不会永远阻塞
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, n):
+        """额度足够时占用 n 字节并返回 True，否则立即返回 False"""
+        with self._lock:
+            if self._inflight > 0 and self._inflight + n > self.limit:
+                return False
+            self._inflight += n
+            return True
+
+    def release(self, n):
+        with self._lock:
+            self._inflight -= n
+
+
+# 每个目标目录根下的同步清单文件名
+MANIFEST_NAME = '.copy4bk-manifest.json'
+MANIFEST_VERSION = 1
+
+# 一次复制任务：把 latest_file 复制为 target_file
+# index 决定结果输出顺序；action 为日志中显示的动作（已复制/已替换）
+# basis 为增量复制时使用的基准文件路径（目标子目录中已有的旧版本），None 表示整文件复制
+CopyJob = namedtuple('CopyJob', ['index', 'target_dir', 'subdir_name', 'latest_file', 'target_file', 'action',
+                                 'basis'])
+CopyJob.__new__.__defaults__ = (None,)
+CopyResult = namedtuple('CopyResult', ['job', 'error', 'backend', 'digest'])
+CopyResult.__new__.__defaults__ = (None,)
+
+
+def load_manifest(target_dir):
+    """
+    读取目标目录的同步清单，不存在或损坏时返回空清单
+    清单格式：{"version": 1, "files": {"子目录/文件名": {"source", "size", "mtime_ns", "digest"}}}
+    """
+    manifest_path = os.path.join(str(target_dir), MANIFEST_NAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == MANIFEST_VERSION and isinstance(data.get('files'), dict):
+            return data
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {'version': MANIFEST_VERSION, 'files': {}}
+
+
+def save_manifest(target_dir, manifest):
+    """先写临时文件再替换，避免中途中断留下半个清单"""
+    manifest_path = os.path.join(str(target_dir), MANIFEST_NAME)
+    tmp_path = manifest_path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        print(f"  保存同步清单失败 {manifest_path}: {str(e)}")
+
+
+def load_manifests(target_configs):
+    """读取所有启用了同步清单的目标目录的清单，返回 {目标目录: 清单}"""
+    return {str(td): load_manifest(td) for td, cfg in target_configs if cfg.get('manifest', True)}
+
+
+def prune_manifest(manifest, plan, full=False):
+    """
+    删除清单中已不在计划里的记录：计划中各子目录里不再是最新文件的记录（新版本取代、被清理或源文件已删除）
+    full: plan 是否覆盖整个源目录；是时连同计划中没有的子目录的记录一起删除（监视模式只传入变化的子目录）
+    """
+    latest = {entry.subdir_name: {f.name for f in entry.files} for entry in plan.entries}
+    for key in list(manifest['files']):
+        subdir_name, _, file_name = key.rpartition('/')
+        names = latest.get(subdir_name)
+        if names is None and not full:
+            continue
+        if names is None or file_name not in names:
+            del manifest['files'][key]
+
+
+def save_manifests(manifests, originals, plan, full=False):
+    """清理过期记录后保存有变化的清单；originals 为读取时各清单 files 的副本"""
+    for td, manifest in manifests.items():
+        prune_manifest(manifest, plan, full)
+        if manifest['files'] != originals[td]:
+            save_manifest(td, manifest)
+
+
+def _manifest_key(subdir_name, file_name):
+    return f"{subdir_name}/{file_name}"
+
+
+def record_manifest_entry(manifest, subdir_name, latest_file, digest=None):
+    """记录一个已送达目标目录的文件身份"""
+    manifest['files'][_manifest_key(subdir_name, latest_file.name)] = {
+        'source': latest_file.path,
+        'size': latest_file.stat.st_size,
+        'mtime_ns': latest_file.stat.st_mtime_ns,
+        'digest': digest,
+    }
+
+
+def is_unchanged(manifest, subdir_name, latest_file, target_file):
+    """
+    判断目标文件是否与清单记录、源文件完全一致，一致时无需复制也无需询问
+    只比较路径、大小和 st_mtime_ns，不打开任何文件
+    """
+    if manifest is None:
+        return False
+    record = manifest['files'].get(_manifest_key(subdir_name, latest_file.name))
+    if not record:
+        return False
+    src_st = latest_file.stat
+    if (record.get('source') != latest_file.path or record.get('size') != src_st.st_size
+            or record.get('mtime_ns') != src_st.st_mtime_ns):
+        return False
+    try:
+        dst_st = os.stat(target_file)
+    except OSError:
+        return False
+    # copy2/copystat 会把源文件的修改时间带到目标文件上
+    return dst_st.st_size == src_st.st_size and dst_st.st_mtime_ns == src_st.st_mtime_ns
+
+
+def prepare_copy_jobs(plan, target_dir, config=None, start_index=0, manifest=None, dry_run=False):
+    """
+    按计划为一个目标目录生成复制任务（串行执行：创建目录、处理已存在的文件）
+    manifest: 该目标目录的同步清单，记录一致的文件直接跳过
+    dry_run: 为 True 时不创建目录、不询问，只生成计划
+    真正的文件复制交给 run_copy_jobs 并发完成；旧文件在复制完成后由 apply_retention 清理
+    返回 CopyJob 列表
+    """
+    if config is None:
+        config = {}
+
+    target_path = Path(target_dir)
+
+    # 创建目标目录（如果不存在）
+    if not dry_run:
+        target_path.mkdir(parents=True, exist_ok=True)
+
+    conflict = config.get('conflict', DEFAULT_CONFLICT_POLICY)
+    metrics = get_metrics()
+
+    jobs = []
+    # 遍历计划中的每个子目录
+    for entry in plan.entries:
+        subdir_name = entry.subdir_name
+        print(f"\n处理子目录: {subdir_name}")
+
+        latest_files = entry.files
+
+        if not latest_files:
+            print(f"  子目录 {subdir_name} 中没有找到包含版本号的文件")
+            continue
+
+        # 创建目标子目录
+        target_subdir = target_path / subdir_name
+        if not dry_run:
+            target_subdir.mkdir(parents=True, exist_ok=True)
+
+        # 增量复制：为每个新文件选好基准文件
+        bases = {}
+        if config.get('delta', False) and delta_supported():
+            for latest_file in latest_files:
+                basis = find_delta_basis(target_subdir, latest_file)
+                if basis is not None:
+                    bases[latest_file.name] = basis
+
+        for latest_file in latest_files:
+            file_name = latest_file.name
+            target_file = target_subdir / file_name
+
+            # 清单中记录的文件身份一致：已是同一个文件，不复制也不询问
+            if is_unchanged(manifest, subdir_name, latest_file, target_file):
+                print(f"  未变化，跳过: {file_name}")
+                metrics.add('files_skipped', target=target_dir, subdir=subdir_name)
+                continue
+
+            # 检查目标文件是否已存在
+            file_exists = target_file.exists()
+
+            # 开启校验时先比较内容，内容相同则无需替换，也不必询问
+            if file_exists and config.get('verify', False):
+                algorithm = config.get('hash', DEFAULT_HASH_ALGORITHM)
+                cache = get_digest_cache()
+                if files_identical(latest_file.path, str(target_file), algorithm, cache):
+                    print(f"  内容相同，跳过: {file_name}")
+                    metrics.add('files_skipped', target=target_dir, subdir=subdir_name)
+                    if manifest is not None:
+                        digest = file_digest(latest_file.path, algorithm, cache)
+                        record_manifest_entry(manifest, subdir_name, latest_file, f"{algorithm}:{digest}")
+                    continue
+
+            if file_exists:
+                if dry_run and conflict == 'ask':
+                    # 预演时不询问，按"将询问"列出
+                    print(f"  [已存在，运行时将询问] {file_name}")
+                else:
+                    start = time.perf_counter()
+                    replace = should_replace(conflict, latest_file, target_file)
+                    if conflict == 'ask':
+                        metrics.add('prompt_wait_s', time.perf_counter() - start, target=target_dir)
+                    if not replace:
+                        print(f"  已跳过: {file_name}")
+                        metrics.add('files_skipped', target=target_dir, subdir=subdir_name)
+                        continue
+                metrics.add('files_replaced', target=target_dir, subdir=subdir_name)
+
+            action = "已替换" if file_exists else "已复制"
+            jobs.append(CopyJob(start_index + len(jobs), str(target_dir), subdir_name,
+                                latest_file, target_file, action, bases.get(file_name)))
+
+    return jobs
+
+
+def find_delta_basis(target_subdir, latest_file):
+    """
+    为增量复制挑选基准文件：
+    1) 目标子目录中的同名文件（同版本重新发布）
+    2) 否则取扩展名相同、版本号小于新文件的旧版本中版本号最大的一个
+       （新文件没有可比较的版本号时，改为取修改时间不晚于新文件的最新一个）
+    没有合适的基准时返回 None
+    """
+    ext = os.path.splitext(latest_file.name)[1].lower()
+    new_version = parse_version(latest_file.name)
+    best = None
+    best_key = None
+    try:
+        it = os.scandir(target_subdir)
+    except OSError:
+        return None
+    with it:
+        for entry in it:
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            if st.st_size == 0 or _is_internal_file(entry.name):
+                continue
+            if entry.name == latest_file.name:
+                return entry.path
+            version = parse_version(entry.name)
+            if os.path.splitext(entry.name)[1].lower() != ext or version is None:
+                continue
+            if new_version is not None:
+                if version >= new_version:
+                    continue
+                key = (version, st.st_mtime_ns)
+            else:
+                if st.st_mtime_ns > latest_file.stat.st_mtime_ns:
+                    continue
+                key = ((), st.st_mtime_ns)
+            if best_key is None or key > best_key:
+                best = entry.path
+                best_key = key
+    return best
+
+
+def _build_block_index(basis_path, block_size):
+    """
+    计算基准文件每个对齐块的弱校验（adler32）和强校验（blake2b），返回 {弱校验: [(强校验, 偏移)]}
+    """
+    index = {}
+    with open(basis_path, 'rb') as f:
+        offset = 0
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            weak = zlib.adler32(block)
+            strong = hashlib.blake2b(block, digest_size=16).digest()
+            index.setdefault(weak, []).append((strong, offset, len(block)))
+            offset += len(block)
+    return index
+
+
+def delta_supported():
+    """
+    增量复制是否有意义：基准块要靠 copy_file_range 在内核中复制（Linux），
+    否则每个字节仍要写入目标文件，比整文件复制（Windows/macOS 上可用系统复制接口）更慢，此时改为整文件复制
+    """
+    return hasattr(os, 'copy_file_range') and sys.platform.startswith('linux')
+
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def _resync_block(fbasis, block, expected, basis_size, window=DELTA_SEARCH_WINDOW):
+    """
+    在基准文件 [expected - window, expected + window] 范围内查找与 block 完全相同的数据，返回其偏移，找不到时返回 None
+    用于源文件插入或删除了若干字节后，后续内容在基准文件中整体错位的情况
+    """
+    start = max(0, expected - window)
+    end = min(basis_size, expected + window + len(block))
+    if end - start < len(block):
+        return None
+    data = _read_at(fbasis, start, end - start)
+    probe = block[:DELTA_PROBE_SIZE]
+    pos = data.find(probe)
+    checks = 0
+    while pos >= 0 and checks < DELTA_PROBE_CHECKS:
+        if data[pos:pos + len(block)] == block:
+            return start + pos
+        checks += 1
+        pos = data.find(probe, pos + 1)
+    return None
+
+
+def _write_all(fd, data):
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+
+def delta_copy(src, dst, basis, block_size=DELTA_BLOCK_SIZE, throttle=None):
+    """
+    以目标目录中已有的旧版本 basis 为基准，增量生成 dst：
+    源文件按块读取，依次在基准文件中查找相同的数据：
+    1) 与上一个命中块相同的相对位置（未改动的部分、或插入/删除字节后整体错位的部分）
+    2) 基准文件中任意对齐块（adler32 + blake2b）
+    3) 预期位置附近的任意偏移（重新对齐，见 _resync_block）
+    找到时从基准文件取数据，否则写入源数据
+    基准块在支持 copy_file_range 的系统上由内核（Btrfs/XFS 上为共享数据块，SMB/NFS 上为服务端复制）完成，
+    不经过用户态，也不额外占用目标端的写入带宽
+    先写入同目录下的临时文件，完成后替换 dst，因此 basis 可以就是 dst 本身
+    throttle: 限速器，只对实际写入的源数据消耗令牌
+    返回复用基准数据的字节数占比（0~1）
+    """
+    index = _build_block_index(basis, block_size)
+    tmp_path = os.path.join(os.path.dirname(str(dst)), f".{os.path.basename(str(dst))}.copy4bk-delta")
+    use_kernel = delta_supported()
+
+    matched = 0
+    total = 0
+    shift = 0   # 基准文件中对应数据相对源文件的偏移
+    misses = 0  # 连续重新对齐失败的块数
+    try:
+        with open(src, 'rb') as fsrc, open(basis, 'rb') as fbasis, open(tmp_path, 'wb') as fdst_obj:
+            fdst = fdst_obj.fileno()
+            basis_fd = fbasis.fileno()
+            basis_size = os.fstat(basis_fd).st_size
+            while True:
+                block = fsrc.read(block_size)
+                if not block:
+                    break
+                match = None
+                expected = total + shift
+                if 0 <= expected and expected + len(block) <= basis_size \
+                        and _read_at(fbasis, expected, len(block)) == block:
+                    match = expected
+                if match is None:
+                    candidates = index.get(zlib.adler32(block))
+                    if candidates:
+                        strong = hashlib.blake2b(block, digest_size=16).digest()
+                        for cand_strong, cand_offset, cand_len in candidates:
+                            if cand_len == len(block) and cand_strong == strong:
+                                match = cand_offset
+                                break
+                if match is None and misses < DELTA_RESYNC_LIMIT:
+                    match = _resync_block(fbasis, block, expected, basis_size)
+                    misses = 0 if match is not None else misses + 1
+                if match is not None:
+                    shift = match - total
+                    misses = 0
+
+                if match is not None and use_kernel:
+                    done = 0
+                    try:
+                        while done < len(block):
+                            n = os.copy_file_range(basis_fd, fdst, len(block) - done,
+                                                   match + done, total + done)
+                            if n == 0:
+                                break
+                            done += n
+                    except OSError:
+                        use_kernel = False
+                    if done == len(block):
+                        os.lseek(fdst, total + done, os.SEEK_SET)
+                        matched += len(block)
+                        total += len(block)
+                        continue
+                    # 内核复制不可用：剩余部分直接写入已读到的源数据（内容与基准块相同）
+                    os.lseek(fdst, total + done, os.SEEK_SET)
+                    if throttle is not None:
+                        throttle.consume(len(block) - done)
+                    _write_all(fdst, block[done:])
+                    matched += len(block)
+                    total += len(block)
+                    continue
+
+                if throttle is not None:
+                    throttle.consume(len(block))
+                _write_all(fdst, block)
+                if match is not None:
+                    matched += len(block)
+                total += len(block)
+
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, str(dst))
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return matched / total if total else 0.0
+
+
+class _BackendUnsupported(Exception):
+    """当前后端在该文件系统组合上不可用"""
+
+
+def _copy_reflink(fsrc, fdst, size):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise _BackendUnsupported()
+    try:
+        fcntl.ioctl(fdst, FICLONE, fsrc)
+    except OSError as e:
+        if e.errno in _UNSUPPORTED_ERRNOS:
+            raise _BackendUnsupported()
+        raise
+
+
+def _copy_kernel_range(fsrc, fdst, size, use_sendfile, throttle=None, start=0):
+    func = getattr(os, 'sendfile' if use_sendfile else 'copy_file_range', None)
+    if func is None or not sys.platform.startswith('linux'):
+        raise _BackendUnsupported()
+    chunk_size = THROTTLE_CHUNK_SIZE if throttle is not None else KERNEL_CHUNK_SIZE
+    if use_sendfile:
+        # sendfile 写入目标文件的当前位置
+        os.lseek(fdst, start, os.SEEK_SET)
+    copied = start
+    while copied < size:
+        count = min(chunk_size, size - copied)
+        if throttle is not None:
+            throttle.consume(count)
+        try:
+            if use_sendfile:
+                n = os.sendfile(fdst, fsrc, copied, count)
+            else:
+                n = os.copy_file_range(fsrc, fdst, count, copied, copied)
+        except OSError as e:
+            if copied == start and e.errno in _UNSUPPORTED_ERRNOS:
+                raise _BackendUnsupported()
+            raise
+        if n == 0:
+            if copied == start:
+                # 某些文件系统静默返回 0，视为不支持
+                raise _BackendUnsupported()
+            break
+        copied += n
+
+
+def _copy_buffered(fsrc, fdst, size, throttle=None, start=0):
+    # 复用同一块缓冲区（POSIX 下用 readv 直接读入），避免每块都分配新的 bytes
+    chunk_size = THROTTLE_CHUNK_SIZE if throttle is not None else BUFFERED_CHUNK_SIZE
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    os.lseek(fsrc, start, os.SEEK_SET)
+    os.lseek(fdst, start, os.SEEK_SET)
+    remaining = size - start
+    while remaining > 0:
+        want = min(chunk_size, remaining)
+        if hasattr(os, 'readv'):
+            n = os.readv(fsrc, [view[:want]])
+            data = view[:n]
+        else:
+            data = os.read(fsrc, want)
+            n = len(data)
+        if not n:
+            break
+        if throttle is not None:
+            throttle.consume(n)
+        written = 0
+        while written < n:
+            written += os.write(fdst, data[written:n])
+        remaining -= n
+
+
+def _run_backend(name, fsrc, fdst, size, throttle=None, start=0):
+    """用指定后端复制源文件 [start, size) 这一段到目标文件的相同位置"""
+    if name == 'reflink':
+        # 反射链接只共享数据块、不写入数据，不受限速影响；只用于整个文件
+        _copy_reflink(fsrc, fdst, size)
+    elif name == 'copy_file_range':
+        _copy_kernel_range(fsrc, fdst, size, use_sendfile=False, throttle=throttle, start=start)
+    elif name == 'sendfile':
+        _copy_kernel_range(fsrc, fdst, size, use_sendfile=True, throttle=throttle, start=start)
+    else:
+        _copy_buffered(fsrc, fdst, size, throttle, start)
+
+
+def _copy_with_backends(fsrc, fdst, src_st, throttle=None, start=0, end=None):
+    """
+    依次尝试 COPY_BACKENDS 复制源文件 [start, end) 这一段，返回实际使用的后端名称
+    只复制一段时（start > 0 或 end 小于文件大小）跳过 reflink，且不据此更新能力缓存
+    """
+    end = src_st.st_size if end is None else end
+    whole_file = start == 0 and end == src_st.st_size
+    key = (src_st.st_dev, os.fstat(fdst).st_dev)
+
+    with _backend_cache_lock:
+        first = _backend_cache.get(key, 0)
+
+    for idx in range(first, len(COPY_BACKENDS)):
+        name = COPY_BACKENDS[idx]
+        if name == 'reflink' and not whole_file:
+            continue
+        try:
+            _run_backend(name, fsrc, fdst, end, throttle, start)
+        except _BackendUnsupported:
+            # 清掉可能写入的部分内容，换下一个后端
+            os.ftruncate(fdst, start)
+            os.lseek(fdst, start, os.SEEK_SET)
+            continue
+        if idx != first and whole_file:
+            with _backend_cache_lock:
+                _backend_cache[key] = idx
+        return name
+
+    # buffered 不会抛出 _BackendUnsupported，理论上不会走到这里
+    raise OSError("没有可用的复制后端")
+
+
+def copy_file_data(src, dst, throttle=None):
+    """
+    复制文件内容（不含元数据），依次尝试 reflink、copy_file_range、sendfile、用户态大缓冲循环
+    每种源/目标设备组合只探测一次，结果缓存在 _backend_cache 中
+    throttle: 限速器（见 Throttle），按块消耗令牌
+    返回实际使用的后端名称
+    """
+    with open(src, 'rb') as fsrc_obj, open(dst, 'wb') as fdst_obj:
+        fsrc = fsrc_obj.fileno()
+        return _copy_with_backends(fsrc, fdst_obj.fileno(), os.fstat(fsrc), throttle)
+
+
+def staging_path(dst):
+    """dst 的暂存文件路径：与 dst 同目录，以 . 开头，清理旧文件时不会被当作版本文件"""
+    return os.path.join(os.path.dirname(str(dst)), f".{os.path.basename(str(dst))}.copy4bk-part")
+
+
+def _progress_path(part_path):
+    return part_path + '.json'
+
+
+def has_resume_state(dst):
+    """dst 是否有上次中断留下、可续传的暂存文件"""
+    return os.path.exists(_progress_path(staging_path(dst)))
+
+
+def _remove_staging(dst):
+    """删除 dst 的暂存文件和进度文件（如果有）"""
+    part = staging_path(dst)
+    for path in (part, _progress_path(part)):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def remove_stale_staging(target_dir, plan, keep_files=()):
+    """
+    删除计划中各子目录里过期的暂存文件和进度文件：对应的源文件已不在计划中（被删除或已被新版本取代），
+    或本次已复制完成/跳过。keep_files 为本次复制失败、需要保留供下次续传的目标文件路径
+    增量复制的临时文件（.copy4bk-delta）不能续传，进程被强制结束或断电后才会留下，一律删除
+    返回删除的文件数
+    """
+    keep = {os.path.normpath(staging_path(f)) for f in keep_files}
+    removed = 0
+    for entry in plan.entries:
+        target_subdir = os.path.join(str(target_dir), entry.subdir_name)
+        try:
+            it = os.scandir(target_subdir)
+        except OSError:
+            continue
+        with it:
+            for dir_entry in it:
+                name = dir_entry.name
+                if not name.startswith('.'):
+                    continue
+                marker = name.find('.copy4bk-part')
+                if marker < 0 and not name.endswith('.copy4bk-delta'):
+                    continue
+                if marker >= 0 and os.path.normpath(os.path.join(target_subdir, name[:marker + len('.copy4bk-part')])) in keep:
+                    continue
+                try:
+                    os.unlink(dir_entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _save_progress(progress_path, src_st, completed):
+    """记录已落盘的字节数；调用前必须先对暂存文件 fsync"""
+    data = {'version': RESUME_VERSION, 'size': src_st.st_size, 'mtime_ns': src_st.st_mtime_ns,
+            'completed': completed}
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, progress_path)
+
+
+def _read_progress(progress_path):
+    """读取进度文件，返回字典；不存在或格式不对时返回 None"""
+    try:
+        with open(progress_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != RESUME_VERSION or not isinstance(data.get('completed'), int):
+            return None
+        return data
+    except (OSError, ValueError, TypeError, AttributeError):
+        return None
+
+
+def _resume_offset(progress_path, src_st, fsrc, fpart):
+    """
+    计算续传起点：进度与当前源文件（大小、修改时间）一致时，从记录的位置往前
+    逐块（RESUME_VERIFY_SIZE）比对暂存文件与源文件，从第一个一致的块之后继续
+    记录之前的数据在写进度前已经 fsync，通常只需比对最后一块；不一致时从头开始
+    """
+    data = _read_progress(progress_path)
+    if data is None or data.get('size') != src_st.st_size or data.get('mtime_ns') != src_st.st_mtime_ns:
+        return 0
+    part_size = os.fstat(fpart.fileno()).st_size
+    offset = min(data['completed'], part_size, src_st.st_size)
+    while offset > 0:
+        block_start = max(0, offset - RESUME_VERIFY_SIZE)
+        fsrc.seek(block_start)
+        fpart.seek(block_start)
+        if fsrc.read(offset - block_start) == fpart.read(offset - block_start):
+            return offset
+        offset = block_start
+    return 0
+
+
+def _copy_resumable(src, part, src_st, throttle=None):
+    """
+    大文件复制到暂存文件：按 RESUME_CHECKPOINT_SIZE 分段，每段用与整文件复制相同的后端
+    （copy_file_range/sendfile/缓冲循环）按偏移复制，完成后 fsync 并记录进度
+    上次中断留下的暂存文件与进度一致时从断点继续；出错时保留暂存文件和进度文件，供下次续传
+    返回 (续传前已完成的字节数, 使用的后端名称)
+    """
+    progress = _progress_path(part)
+    backend = None
+    with open(src, 'rb') as fsrc, open(part, 'r+b' if os.path.exists(part) else 'w+b') as fpart:
+        resumed = _resume_offset(progress, src_st, fsrc, fpart) if os.path.exists(progress) else 0
+        fpart.truncate(resumed)
+        offset = resumed
+        while offset < src_st.st_size:
+            end = min(src_st.st_size, offset + RESUME_CHECKPOINT_SIZE)
+            backend = _copy_with_backends(fsrc.fileno(), fpart.fileno(), src_st, throttle, offset, end)
+            _sync(fpart)
+            _save_progress(progress, src_st, end)
+            offset = end
+    return resumed, backend or 'buffered'
+
+
+def _copy_large(src, part, src_st, throttle=None):
+    """大文件：没有可续传的进度时先尝试反射链接，否则分段可续传复制；返回后端名称"""
+    if not os.path.exists(_progress_path(part)):
+        try:
+            with open(src, 'rb') as fsrc, open(part, 'wb') as fpart:
+                _copy_reflink(fsrc.fileno(), fpart.fileno(), src_st.st_size)
+            return 'reflink'
+        except _BackendUnsupported:
+            pass
+    resumed, backend = _copy_resumable(src, part, src_st, throttle)
+    if resumed:
+        return f"{backend}(续传自 {format_size(resumed)})"
+    return backend
+
+
+def copy_file(src, dst, throttle=None):
+    """
+    与 shutil.copy2 等价：复制内容后保留时间戳和权限信息
+    先写入同目录下的暂存文件（见 staging_path），完成后原子替换 dst，中断时不会留下截断的正式文件
+    不小于 RESUME_MIN_SIZE 的文件分块记录进度，中断后再次复制时从断点继续
+    返回使用的复制后端名称
+    """
+    part = staging_path(dst)
+    src_st = os.stat(src)
+    resumable = src_st.st_size >= RESUME_MIN_SIZE
+    try:
+        if resumable:
+            backend = _copy_large(src, part, src_st, throttle)
+        else:
+            backend = copy_file_data(src, part, throttle)
+        shutil.copystat(src, part)
+        os.replace(part, str(dst))
+    except BaseException:
+        if not resumable:
+            _remove_staging(dst)
+        raise
+    _remove_staging(dst)
+    return backend
+
+
+def tee_copy(src, dsts, chunk_size=TEE_CHUNK_SIZE, throttles=None):
+    """
+    扇出复制：源文件只读一遍，每读到一块就依次写入所有目标文件
+    复制完成后对每个目标执行 shutil.copystat，与 shutil.copy2 保留相同的时间戳和权限信息
+    某个目标写入失败时关闭并删除该目标的残留文件，其余目标继续
+    throttles: 与 dsts 一一对应的限速器（None 表示不限速），每写入一块消耗对应目标的令牌
+    与 copy_file 一样先写入暂存文件再原子替换；大文件为每个目标记录续传进度，
+    中断后各目标在下次运行时单独续传（见 run_copy_jobs 的分组）
+    返回与 dsts 一一对应的错误列表（成功为 None）
+    """
+    errors = [None] * len(dsts)
+    outputs = [None] * len(dsts)
+    parts = [staging_path(dst) for dst in dsts]
+    if throttles is None:
+        throttles = [None] * len(dsts)
+    if any(throttles):
+        chunk_size = min(chunk_size, THROTTLE_CHUNK_SIZE)
+
+    resumable = False
+    try:
+        with open(src, 'rb') as fsrc:
+            src_st = os.fstat(fsrc.fileno())
+            resumable = src_st.st_size >= RESUME_MIN_SIZE
+            copied = 0
+            for i, part in enumerate(parts):
+                try:
+                    outputs[i] = open(part, 'wb')
+                except Exception as e:
+                    errors[i] = e
+
+            while any(f is not None for f in outputs):
+                chunk = fsrc.read(chunk_size)
+                if not chunk:
+                    break
+                for i, fdst in enumerate(outputs):
+                    if fdst is None:
+                        continue
+                    try:
+                        if throttles[i] is not None:
+                            throttles[i].consume(len(chunk))
+                        fdst.write(chunk)
+                    except Exception as e:
+                        errors[i] = e
+                        _discard_partial(fdst, parts[i])
+                        outputs[i] = None
+                copied += len(chunk)
+                if resumable and copied % RESUME_CHECKPOINT_SIZE < len(chunk):
+                    for i, fdst in enumerate(outputs):
+                        if fdst is None:
+                            continue
+                        try:
+                            _sync(fdst)
+                            _save_progress(_progress_path(parts[i]), src_st, copied)
+                        except Exception as e:
+                            errors[i] = e
+                            _discard_partial(fdst, parts[i])
+                            outputs[i] = None
+    except Exception as e:
+        # 源文件读取失败：所有尚未失败的目标都记为失败；大文件保留暂存文件供下次续传
+        for i, fdst in enumerate(outputs):
+            if fdst is not None:
+                if resumable:
+                    fdst.close()
+                else:
+                    _discard_partial(fdst, parts[i])
+                outputs[i] = None
+            if errors[i] is None:
+                errors[i] = e
+        return errors
+
+    for i, fdst in enumerate(outputs):
+        if fdst is None:
+            continue
+        try:
+            if resumable:
+                _sync(fdst)
+            fdst.close()
+            shutil.copystat(src, parts[i])
+            os.replace(parts[i], str(dsts[i]))
+            _remove_staging(dsts[i])
+        except Exception as e:
+            errors[i] = e
+
+    return errors
+
+
+def _discard_partial(fdst, part):
+    """关闭并删除写了一半的暂存文件及其进度文件"""
+    try:
+        fdst.close()
+    except Exception:
+        pass
+    for path in (part, _progress_path(part)):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _device_of(path):
+    """返回路径所在设备号，取不到时退化为路径本身（按目标目录独立限流）"""
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return str(path)
+
+
+def run_copy_jobs(jobs, target_concurrency=None, max_workers=DEFAULT_MAX_WORKERS,
+                  device_concurrency=DEFAULT_DEVICE_CONCURRENCY, fanout=False, verify=None,
+                  throttles=None, max_inflight=None, priority=DEFAULT_COPY_PRIORITY):
+    """
+    使用线程池并发执行复制任务
+    target_concurrency: {目标目录: 并发上限}，未列出的目标目录使用 DEFAULT_TARGET_CONCURRENCY
+    device_concurrency: 同一设备上同时进行的复制任务数上限
+    fanout: 为 True 时同一源文件的所有任务合并为一次扇出复制（见 tee_copy），源文件只读一遍
+    verify: {目标目录: 摘要算法}，列出的目标目录在复制后比对源文件与目标文件的摘要
+    throttles: {目标目录: Throttle}，见 make_throttles
+    max_inflight: 同时复制的字节数上限（扇出复制按写入的总字节数计），None 表示不限
+    priority: small-first 按文件从小到大开始复制；plan 按计划顺序
+    结果按任务 index 顺序输出日志，返回 CopyResult 列表（同样有序）
+    """
+    if not jobs:
+        return []
+
+    if target_concurrency is None:
+        target_concurrency = {}
+    if verify is None:
+        verify = {}
+    if throttles is None:
+        throttles = {}
+    budget = ByteBudget(max_inflight) if max_inflight else None
+
+    def verify_result(result):
+        # 复制成功后校验内容，源文件摘要按 stat 缓存，扇出到多个目标时只计算一次
+        job = result.job
+        algorithm = verify.get(job.target_dir)
+        if result.error is not None or algorithm is None:
+            return result
+        cache = get_digest_cache()
+        try:
+            src_digest = file_digest(job.latest_file.path, algorithm, cache)
+            dst_digest = file_digest(str(job.target_file), algorithm, cache)
+        except OSError as e:
+            return result._replace(error=e)
+        if src_digest != dst_digest:
+            return result._replace(error=OSError(f"校验失败，目标文件内容与源文件不一致 ({algorithm})"))
+        return result._replace(digest=f"{algorithm}:{src_digest}")
+
+    # 为每个目标目录、每个设备准备信号量
+    target_locks = {}
+    device_locks = {}
+    job_devices = {}
+    for job in jobs:
+        if job.target_dir not in target_locks:
+            limit = target_concurrency.get(job.target_dir, DEFAULT_TARGET_CONCURRENCY)
+            target_locks[job.target_dir] = threading.BoundedSemaphore(max(1, limit))
+            device = _device_of(job.target_dir)
+            job_devices[job.target_dir] = device
+            if device not in device_locks:
+                device_locks[device] = threading.BoundedSemaphore(max(1, device_concurrency))
+
+    def group_bytes(group):
+        return group[0].latest_file.stat.st_size * len(group)
+
+    def try_acquire(group):
+        # 不阻塞地取得一组任务需要的所有目标目录、设备信号量和在途字节额度；任何一项取不到就全部退回
+        target_keys = sorted({job.target_dir for job in group})
+        device_keys = sorted({job_devices[key] for key in target_keys}, key=str)
+        acquired = []
+        for lock in [target_locks[key] for key in target_keys] + [device_locks[key] for key in device_keys]:
+            if not lock.acquire(blocking=False):
+                break
+            acquired.append(lock)
+        else:
+            if budget is None or budget.try_acquire(group_bytes(group)):
+                return acquired
+        for lock in reversed(acquired):
+            lock.release()
+        return None
+
+    def run_group(group, acquired):
+        # 一组任务共享同一个源文件；调度时已取得所需的信号量（acquired）和在途字节额度，完成后在这里归还
+        start = time.perf_counter()
+        try:
+            if len(group) == 1:
+                job = group[0]
+                throttle = throttles.get(job.target_dir)
+                if job.basis is not None:
+                    try:
+                        ratio = delta_copy(job.latest_file.path, job.target_file, job.basis, throttle=throttle)
+                        _remove_staging(job.target_file)
+                        return [verify_result(CopyResult(job, None, f"delta(复用 {ratio:.0%})"))]
+                    except Exception:
+                        # 基准文件不可用等情况，退回整文件复制
+                        pass
+                try:
+                    backend = copy_file(job.latest_file.path, job.target_file, throttle)
+                    return [verify_result(CopyResult(job, None, backend))]
+                except Exception as e:
+                    return [CopyResult(job, e, None)]
+
+            errors = tee_copy(group[0].latest_file.path, [job.target_file for job in group],
+                              throttles=[throttles.get(job.target_dir) for job in group])
+            return [verify_result(CopyResult(job, error, 'tee')) for job, error in zip(group, errors)]
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            if budget is not None:
+                budget.release(group_bytes(group))
+            # 各目标目录、子目录实际占用复制槽位的时间（不含排队等待）
+            elapsed = time.perf_counter() - start
+            for job in group:
+                get_metrics().add('copy_busy_s', elapsed, target=job.target_dir, subdir=job.subdir_name)
+
+    ordered_jobs = sorted(jobs, key=lambda j: j.index)
+
+    # 分组：扇出模式下同一源文件的任务归为一组，否则每个任务单独一组
+    groups = []
+    if fanout:
+        group_by_src = {}
+        for job in ordered_jobs:
+            throttle = throttles.get(job.target_dir)
+            if (job.basis is not None or has_resume_state(job.target_file)
+                    or (throttle is not None and throttle.per_target)):
+                # 增量复制的任务各自使用目标端的基准文件，有续传进度的任务各自从断点继续，
+                # 有自己限速的目标目录单独复制（扇出时各目标串行消耗令牌，会拖慢同组的其他目标），都不参与扇出
+                groups.append([job])
+                continue
+            key = job.latest_file.path
+            if key not in group_by_src:
+                group_by_src[key] = []
+                groups.append(group_by_src[key])
+            group_by_src[key].append(job)
+    else:
+        groups = [[job] for job in ordered_jobs]
+    if priority == 'small-first':
+        # 按优先级调度：小文件先完成，同步客户端可以先处理它们，大安装包排在最后
+        groups.sort(key=lambda g: g[0].latest_file.stat.st_size)
+
+    # 按所涉及的目标目录分队：同一队列的任务需要相同的信号量，队首取不到时直接看下一个队列。
+    # 只有取得信号量的任务才提交给线程池，线程不会因为等待某个目标目录而空占，其他目标目录的任务照常进行
+    queues = {}
+    for order, group in enumerate(groups):
+        key = tuple(sorted({job.target_dir for job in group}))
+        queues.setdefault(key, deque()).append((order, group))
+
+    workers = max(1, min(max_workers, len(groups)))
+    finished = queue.Queue()
+    running = 0
+    completed = {}
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while queues or running:
+            # 在未被阻塞的队列中按优先级取队首提交，直到线程占满或所有队列都取不到信号量
+            blocked = set()
+            while running < workers:
+                ready = [key for key in queues if key not in blocked]
+                if not ready:
+                    break
+                key = min(ready, key=lambda k: queues[k][0][0])
+                acquired = try_acquire(queues[key][0][1])
+                if acquired is None:
+                    blocked.add(key)
+                    continue
+                _, group = queues[key].popleft()
+                if not queues[key]:
+                    del queues[key]
+                executor.submit(run_group, group, acquired).add_done_callback(finished.put)
+                running += 1
+
+            # 信号量在任务结束时归还，之后才会收到完成通知，因此每次完成后都能继续调度
+            future = finished.get()
+            running -= 1
+            for result in future.result():
+                completed[result.job.index] = result
+
+            # 按任务顺序输出已完成的结果，保证日志顺序稳定
+            while len(results) < len(ordered_jobs) and ordered_jobs[len(results)].index in completed:
+                result = completed.pop(ordered_jobs[len(results)].index)
+                _print_copy_result(result)
+                _record_copy_result(result)
+                results.append(result)
+
+    return results
+
+
+def _print_copy_result(result):
+    job = result.job
+    file_name = job.latest_file.name
+    location = f"{job.target_dir} / {job.subdir_name}"
+    if result.error is not None:
+        print(f"  复制失败 {file_name} -> {location}: {str(result.error)}")
+        return
+    mod_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job.latest_file.stat.st_mtime))
+    print(f"  {job.action}: {file_name} -> {location} (修改时间: {mod_time}, 方式: {result.backend})")
+
+
+def _record_copy_result(result):
+    job = result.job
+    metrics = get_metrics()
+    if result.error is not None:
+        metrics.add('copy_errors', target=job.target_dir, subdir=job.subdir_name)
+        return
+    metrics.add('files_copied', target=job.target_dir, subdir=job.subdir_name)
+    metrics.add('bytes_copied', job.latest_file.stat.st_size, target=job.target_dir, subdir=job.subdir_name)
+
+
+def copy_to_targets(plan, target_configs, max_workers=DEFAULT_MAX_WORKERS,
+                    device_concurrency=DEFAULT_DEVICE_CONCURRENCY, fanout=None, announce=True,
+                    dry_run=False, retention=True, throttles=None, max_inflight=None,
+                    priority=DEFAULT_COPY_PRIORITY, manifests=None):
+    """
+    把同一份计划分发到所有目标目录：先逐个目标目录生成任务，再把全部任务一起并发复制
+    target_configs: read_config 返回的 [(目标目录, 配置字典), ...]
+    fanout: 是否使用扇出复制（源文件只读一遍写入所有目标）；None 表示目标目录多于一个时自动启用
+    announce: 是否打印每个目标目录的标题行
+    dry_run: 只打印复制/删除计划和字节数合计，不改动任何文件，返回空列表
+    retention: 复制完成后是否按保留规则清理旧文件（分批复制时由调用方在最后统一清理）
+    throttles/max_inflight/priority: I/O 调度参数，见 run_copy_jobs；throttles 为 None 时按各目标目录的
+    throttle 选项现场创建（多次调用时应由调用方用 make_throttles 创建一次后传入）
+    复制完成后更新各目标目录的同步清单（见 load_manifest）
+    manifests: 调用方用 load_manifests 读取的清单，本函数只记录不保存，由调用方在最后用 save_manifests 统一保存；
+    None 表示本函数自行读取并在复制完成后保存
+    """
+    if fanout is None:
+        fanout = len(target_configs) > 1
+    if throttles is None:
+        throttles = make_throttles(target_configs)
+
+    save = manifests is None and not dry_run
+    if manifests is None:
+        manifests = load_manifests(target_configs)
+    manifests_before = {td: dict(m['files']) for td, m in manifests.items()} if save else None
+
+    jobs = []
+    target_concurrency = {}
+    verify = {}
+    for td, cfg in target_configs:
+        if announce:
+            print(f"\n=> 正在处理目标目录: {td}")
+            if retention_enabled(cfg):
+                print(f"  清理旧文件功能: 启用（{describe_retention(cfg)}）")
+        target_concurrency[str(td)] = cfg.get('concurrency', DEFAULT_TARGET_CONCURRENCY)
+        if cfg.get('verify', False):
+            verify[str(td)] = cfg.get('hash', DEFAULT_HASH_ALGORITHM)
+        with get_metrics().phase('prepare'):
+            jobs.extend(prepare_copy_jobs(plan, td, cfg, start_index=len(jobs),
+                                          manifest=manifests.get(str(td)), dry_run=dry_run))
+
+    if dry_run:
+        deletions = []
+        for td, cfg in target_configs:
+            if retention_enabled(cfg):
+                print(f"\n=> 目标目录 {td} 的清理计划:")
+                deletions.extend(apply_retention(plan, td, cfg, dry_run=True))
+        print_dry_run_plan(jobs, deletions)
+        return []
+
+    if jobs:
+        print(f"\n开始复制 {len(jobs)} 个文件...")
+    with get_metrics().phase('copy'):
+        results = run_copy_jobs(jobs, target_concurrency, max_workers, device_concurrency, fanout, verify,
+                                throttles, max_inflight, priority)
+
+    # 记录成功送达的文件，下次运行时据此跳过未变化的文件
+    for result in results:
+        job = result.job
+        manifest = manifests.get(job.target_dir)
+        if manifest is None or result.error is not None:
+            continue
+        record_manifest_entry(manifest, job.subdir_name, job.latest_file, result.digest)
+    if save:
+        save_manifests(manifests, manifests_before, plan)
+
+    # 中断留下的暂存文件只为本次仍失败的文件保留，其余（源文件已变化或消失）一并删除
+    failed = [str(r.job.target_file) for r in results if r.error is not None]
+    for td, _ in target_configs:
+        remove_stale_staging(td, plan, failed)
+
+    if retention:
+        apply_retention_to_targets(plan, target_configs, results)
+
+    if verify:
+        get_digest_cache().save()
+
+    return results
+
+
+def apply_retention_to_targets(plan, target_configs, results):
+    """新文件都已就位后再清理旧文件；有复制失败的子目录保留旧版本"""
+    failed = {}
+    for result in results:
+        if result.error is not None:
+            failed.setdefault(result.job.target_dir, set()).add(result.job.subdir_name)
+    for td, cfg in target_configs:
+        if retention_enabled(cfg):
+            print(f"\n=> 清理目标目录: {td}")
+            with get_metrics().phase('clean'):
+                apply_retention(plan, td, cfg, failed.get(str(td), ()))
+
+
+STREAM_BATCH_SIZE = 32  # 边扫描边复制时，每攒够这么多个子目录就开始复制一批
+
+
+def copy_streaming(source_dir, target_configs, entries, batch_size=STREAM_BATCH_SIZE, **kwargs):
+    """
+    边扫描边复制：entries 通常是 walk_latest_groups 生成器，每攒够 batch_size 个子目录就复制一批，
+    不必等整个源目录扫描完成；全部复制结束后再统一按保留规则清理旧文件
+    其余参数传给 copy_to_targets；返回 (完整的 LatestPlan, 全部 CopyResult)
+    同步清单只在开始时读取一次、全部复制结束后保存一次，并删除已不在计划中的记录
+    """
+    manifests = load_manifests(target_configs)
+    manifests_before = {td: dict(m['files']) for td, m in manifests.items()}
+    kwargs['manifests'] = manifests
+    all_entries = []
+    results = []
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        all_entries.append(entry)
+        if len(batch) >= batch_size:
+            results.extend(copy_to_targets(LatestPlan(str(source_dir), tuple(batch)), target_configs,
+                                           retention=False, **kwargs))
+            batch = []
+    if batch:
+        results.extend(copy_to_targets(LatestPlan(str(source_dir), tuple(batch)), target_configs,
+                                       retention=False, **kwargs))
+
+    plan = LatestPlan(str(source_dir), tuple(all_entries))
+    save_manifests(manifests, manifests_before, plan, full=True)
+    apply_retention_to_targets(plan, target_configs, results)
+    return plan, results
+
+
+def describe_retention(config):
+    parts = []
+    keep = retention_keep(config)
+    if keep is None:
+        parts.append("不限版本数")
+    elif config.get('keep'):
+        parts.append(f"保留 {keep} 个版本")
+    else:
+        parts.append("只保留最新版本")
+    if config.get('max_bytes'):
+        parts.append(f"总大小不超过 {format_size(config['max_bytes'])}")
+    return "，".join(parts)
+
+
+def print_dry_run_plan(jobs, deletions):
+    """打印预演计划：每个将要复制的文件以及复制、删除的文件数和字节数合计"""
+    print("\n===== 预演计划（未改动任何文件） =====")
+    copy_bytes = 0
+    for job in sorted(jobs, key=lambda j: j.index):
+        size = job.latest_file.stat.st_size
+        copy_bytes += size
+        action = "将替换" if job.action == "已替换" else "将复制"
+        print(f"  [{action}] {job.latest_file.name} -> {job.target_dir} / {job.subdir_name} ({format_size(size)})")
+    delete_bytes = sum(size for _, size in deletions)
+    print(f"\n合计：复制 {len(jobs)} 个文件 ({format_size(copy_bytes)})，"
+          f"删除 {len(deletions)} 个文件 ({format_size(delete_bytes)})")
+
+
+def copy_latest_files(source_dir, target_dir, config=None, plan=None, dry_run=False):
+    """
+    将源目录下每个子目录中的最新版本文件复制到目标目录的对应子目录中
+    config: 目标目录的配置字典，包含 clean_old、concurrency 等选项
+    plan: 预先构建好的最新文件计划（见 build_latest_plan），为 None 时现场扫描源目录
+    target_dir 也可以是目标目录列表，此时使用扇出复制，每个源文件只读一遍写入所有目标
+    dry_run: 只打印计划，不改动任何文件
+    """
+    if config is None:
+        config = {}
+
+    if plan is None:
+        plan = build_latest_plan(source_dir, config.get('select', DEFAULT_SELECT_POLICY))
+
+    if plan is None:
+        print(f"源目录不存在: {source_dir}")
+        return
+
+    if isinstance(target_dir, (list, tuple)):
+        copy_to_targets(plan, [(td, dict(config)) for td in target_dir], fanout=True, dry_run=dry_run)
+    else:
+        copy_to_targets(plan, [(target_dir, config)], fanout=False, announce=False, dry_run=dry_run)
+
+
+# 监视模式默认参数
+DEFAULT_WATCH_INTERVAL = 2.0      # 轮询间隔（秒）；inotify 模式下为有待定变化时的复查间隔
+DEFAULT_WATCH_SETTLE = 10.0       # 子目录内容持续这么久不变才认为写入完成
+WATCH_FULL_RESCAN_INTERVAL = 60.0  # 兜底的完整比对间隔（轮询：覆盖写同名文件不会改变目录修改时间；inotify：事件可能丢失）
+
+
+def snapshot_subdir(subdir_path, depth=1):
+    """
+    记录子目录中所有文件的 (大小, st_mtime_ns)，用于判断是否还在写入
+    depth 大于 1（或为 0 表示不限）时连同下级目录一起记录，键为相对路径
+    目录不存在时返回 None
+    """
+    snapshot = {}
+    stack = [(subdir_path, '', 1)]
+    while stack:
+        path, prefix, level = stack.pop()
+        try:
+            it = os.scandir(path)
+        except OSError:
+            if level == 1:
+                return None
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        snapshot[prefix + entry.name] = (st.st_size, st.st_mtime_ns)
+                    elif entry.is_dir() and (depth == 0 or level < depth):
+                        stack.append((entry.path, f"{prefix}{entry.name}/", level + 1))
+                except OSError:
+                    continue
+    return snapshot
+
+
+def _list_subdirs(source_dir):
+    """返回 {子目录名: 目录的 st_mtime_ns}"""
+    result = {}
+    try:
+        it = os.scandir(source_dir)
+    except OSError:
+        return result
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    result[entry.name] = entry.stat().st_mtime_ns
+            except OSError:
+                continue
+    return result
+
+
+class _PollingWatcher:
+    """
+    轮询方式检测变化：只比较源目录和各子目录自身的修改时间（新增、删除、重命名文件都会改变它），
+    不对文件逐个 stat；每隔 WATCH_FULL_RESCAN_INTERVAL 报告全部子目录，做一次完整比对兜底
+    """
+
+    def __init__(self, source_dir, interval):
+        self.source_dir = source_dir
+        self.interval = interval
+        self.dir_mtimes = _list_subdirs(source_dir)
+        self.last_full = time.monotonic()
+
+    def wait(self, timeout):
+        time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+        current = _list_subdirs(self.source_dir)
+        changed = {name for name, mtime in current.items() if self.dir_mtimes.get(name) != mtime}
+        changed |= set(self.dir_mtimes) - set(current)
+        self.dir_mtimes = current
+        if time.monotonic() - self.last_full >= WATCH_FULL_RESCAN_INTERVAL:
+            self.last_full = time.monotonic()
+            changed |= set(current)
+        return changed
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher:
+    """
+    Linux inotify 方式检测变化（通过 ctypes 调用 libc），空闲时阻塞等待，不占用 CPU
+    监视源目录本身和每个子目录，返回发生变化的子目录名集合
+    事件队列溢出或添加监视失败（如超过 max_user_watches）时事件会丢失，此时报告全部子目录；
+    另外与 _PollingWatcher 一样每隔 WATCH_FULL_RESCAN_INTERVAL 报告全部子目录，做一次完整比对兜底
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+    def __init__(self, source_dir, depth=1):
+        import ctypes
+        import ctypes.util
+        import select
+        import struct
+        self._select = select
+        self._struct = struct
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.source_dir = source_dir
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.depth = depth
+        self.wd_paths = {}
+        self.wd_names = {}   # wd -> (所属的第一级子目录名, 层级)；源目录本身为 ('', 0)
+        self.last_full = time.monotonic()
+        self.needs_full = False    # 有事件丢失，下次 wait 时报告全部子目录
+        self.watch_failed = False  # 已提示过添加监视失败
+        self._add(source_dir, '', 0)
+        for name in _list_subdirs(source_dir):
+            self._add_tree(os.path.join(source_dir, name), name, 1)
+
+    def _add(self, path, name, level):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd >= 0:
+            self.wd_names[wd] = (name, level)
+            self.wd_paths[wd] = path
+            return
+        # 目录在添加前被删除时不必处理；其他失败（多为超过监视数量上限）意味着该目录的变化收不到
+        if os.path.isdir(path):
+            self.needs_full = True
+            if not self.watch_failed:
+                self.watch_failed = True
+                print(f"注意: 无法监视 {path}（可能超过 fs.inotify.max_user_watches），"
+                      f"改为每 {WATCH_FULL_RESCAN_INTERVAL:g} 秒完整比对一次")
+
+    def _all_subdirs(self):
+        """完整比对：报告当前所有子目录，以及已被删除、仍在监视记录中的子目录"""
+        self.last_full = time.monotonic()
+        self.needs_full = False
+        return set(_list_subdirs(self.source_dir)) | {name for name, _ in self.wd_names.values() if name}
+
+    def _add_tree(self, path, name, level):
+        """监视一个目录及其在遍历深度内的下级目录"""
+        self._add(path, name, level)
+        if self.depth == 0 or level < self.depth:
+            for child in _list_child_dirs(path):
+                self._add_tree(os.path.join(path, child), name, level + 1)
+
+    def wait(self, timeout):
+        remaining = WATCH_FULL_RESCAN_INTERVAL - (time.monotonic() - self.last_full)
+        if self.needs_full or remaining <= 0:
+            return self._all_subdirs()
+        timeout = remaining if timeout is None else min(timeout, remaining)
+        readable, _, _ = self._select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        header = self._struct.Struct('iIII')
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset + header.size <= len(data):
+                wd, mask, _cookie, length = header.unpack_from(data, offset)
+                raw_name = data[offset + header.size:offset + header.size + length]
+                offset += header.size + length
+                name = os.fsdecode(raw_name.rstrip(b'\0'))
+                if mask & self.IN_Q_OVERFLOW:
+                    # 队列溢出（wd 为 -1）：之前的事件已丢失
+                    self.needs_full = True
+                    continue
+                info = self.wd_names.get(wd)
+                if info is None:
+                    continue
+                owner, level = info
+                if owner == '':
+                    # 源目录下新增/删除子目录
+                    if mask & self.IN_ISDIR and name:
+                        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                            self._add_tree(os.path.join(self.source_dir, name), name, 1)
+                        changed.add(name)
+                elif mask & self.IN_DELETE_SELF:
+                    del self.wd_names[wd]
+                    self.wd_paths.pop(wd, None)
+                    changed.add(owner)
+                else:
+                    # 遍历深度内新建的下级目录也要监视
+                    if (mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO)
+                            and (self.depth == 0 or level < self.depth)):
+                        self._add_tree(os.path.join(self.wd_paths[wd], name), owner, level + 1)
+                    changed.add(owner)
+        if self.needs_full:
+            changed |= self._all_subdirs()
+        return changed
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+def _create_watcher(source_dir, interval, depth=1):
+    """
+    优先使用 inotify，不可用时（Windows、macOS 或内核限制）退回轮询
+    轮询方式只比较第一级子目录的修改时间，更深层的变化由定期的完整比对发现
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return _InotifyWatcher(source_dir, depth)
+        except Exception as e:
+            print(f"inotify 不可用，改用轮询: {str(e)}")
+    return _PollingWatcher(source_dir, interval)
+
+
+def watch_and_copy(source_dir, target_configs, interval=DEFAULT_WATCH_INTERVAL,
+                   settle=DEFAULT_WATCH_SETTLE, policy=DEFAULT_SELECT_POLICY,
+                   max_depth=DEFAULT_SCAN_DEPTH, include=None, exclude=None,
+                   scan_workers=DEFAULT_SCAN_WORKERS, copy_options=None):
+    """
+    监视模式：先完整同步一次，之后只在源目录的子目录发生变化时处理该子目录
+    变化的子目录要持续 settle 秒内容不变（文件大小、修改时间都不再变化）才会复制，避免复制写了一半的文件
+    copy_options: 传给 copy_to_targets 的其他参数（如 throttles、max_inflight、priority）
+    按 Ctrl+C 退出
+    """
+    # 监视模式无人值守，不能停下来等待按键
+    target_configs = apply_conflict_policy(target_configs, headless=True)
+    copy_options = dict(copy_options or {})
+    # 令牌桶要跨多次复制保持状态
+    copy_options.setdefault('throttles', make_throttles(target_configs))
+
+    if not os.path.isdir(source_dir):
+        print(f"源目录不存在: {source_dir}")
+        return
+    copy_streaming(source_dir, target_configs,
+                   walk_latest_groups(source_dir, max_depth, include, exclude, policy, workers=scan_workers),
+                   **copy_options)
+
+    snapshots = {name: snapshot_subdir(os.path.join(source_dir, name), max_depth)
+                 for name in _list_subdirs(source_dir)}
+    pending = {}  # 子目录名 -> 最近一次检测到变化的时间
+    watcher = _create_watcher(source_dir, interval, max_depth)
+    print(f"\n开始监视源目录: {source_dir}（稳定时间 {settle:g} 秒，按 Ctrl+C 退出）")
+
+    try:
+        while True:
+            if pending:
+                now = time.monotonic()
+                timeout = max(0.0, min(interval, min(settle - (now - t) for t in pending.values())))
+            else:
+                timeout = None
+            changed = watcher.wait(timeout)
+
+            now = time.monotonic()
+            for name in changed | set(pending):
+                snap = snapshot_subdir(os.path.join(source_dir, name), max_depth)
+                if snap != snapshots.get(name):
+                    snapshots[name] = snap
+                    pending[name] = now
+
+            ready = sorted(name for name, t in pending.items() if now - t >= settle)
+            if not ready:
+                continue
+            for name in ready:
+                del pending[name]
+
+            for name in ready:
+                if snapshots.get(name) is None:
+                    snapshots.pop(name, None)
+            roots = [name for name in ready if name in snapshots]
+            entries = list(walk_latest_groups(source_dir, max_depth, include, exclude, policy,
+                                              roots=roots, workers=scan_workers))
+            if entries:
+                print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] 检测到变化: {', '.join(roots)}")
+                copy_to_targets(LatestPlan(str(source_dir), tuple(entries)), target_configs, **copy_options)
+    except KeyboardInterrupt:
+        print("\n已停止监视")
+    finally:
+        watcher.close()
+
+
+DEFAULT_REPORT_PATH = 'copy4bk-report.json'  # 只指定 --profile 时报告和分析结果的保存位置
+PROFILE_TOP_N = 40  # 分析结果文本中列出的函数/分配位置数
+
+
+def start_profiling():
+    """开启 cProfile 和 tracemalloc，返回 stop_profiling 需要的状态"""
+    import cProfile
+    import tracemalloc
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiling(profiler, report_path):
+    """
+    停止分析并把结果写在运行报告旁边：
+    <报告名>.prof（可用 snakeviz 等工具打开）、<报告名>.prof.txt（按累计耗时排序）、
+    <报告名>.memory.txt（内存分配最多的代码行和峰值）
+    """
+    import io
+    import pstats
+    import tracemalloc
+    profiler.disable()
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    base = os.path.splitext(report_path)[0]
+    try:
+        profiler.dump_stats(base + '.prof')
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+        with open(base + '.prof.txt', 'w', encoding='utf-8') as f:
+            f.write(text.getvalue())
+        with open(base + '.memory.txt', 'w', encoding='utf-8') as f:
+            f.write(f"当前 {format_size(current)}，峰值 {format_size(peak)}\n\n")
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+                f.write(f"{stat}\n")
+        print(f"性能分析结果已保存: {base}.prof, {base}.prof.txt, {base}.memory.txt")
+    except OSError as e:
+        print(f"保存性能分析结果失败 {base}: {str(e)}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Copy4bk - 自动复制最新版本文件工具')
+    parser.add_argument('--config', default='copy4bk-win.txt', help='配置文件路径（默认 copy4bk-win.txt）')
+    parser.add_argument('--watch', action='store_true', help='监视模式：持续监视源目录，新版本出现后自动复制')
+    parser.add_argument('--interval', type=float, default=DEFAULT_WATCH_INTERVAL,
+                        help=f'监视模式的轮询/复查间隔秒数（默认 {DEFAULT_WATCH_INTERVAL:g}）')
+    parser.add_argument('--select', choices=SELECT_POLICIES, default=None,
+                        help='最新文件的选择策略：mtime=修改时间（默认），version=版本号，both=先版本号后修改时间')
+    parser.add_argument('--depth', type=int, default=None,
+                        help=f'向下遍历的目录层数，0 表示不限（默认 {DEFAULT_SCAN_DEPTH}）')
+    parser.add_argument('--scan-workers', type=int, default=None,
+                        help=f'并发扫描源目录的线程数（默认 {DEFAULT_SCAN_WORKERS}，即串行；网络共享建议 8~16）')
+    parser.add_argument('--copy-workers', type=int, default=None,
+                        help=f'复制线程池大小，所有目标目录共用（默认 {DEFAULT_MAX_WORKERS}）')
+    parser.add_argument('--device-concurrency', type=int, default=None,
+                        help=f'同一物理设备上同时进行的复制任务数（默认 {DEFAULT_DEVICE_CONCURRENCY}）')
+    parser.add_argument('--include', action='append', default=None, metavar='PATTERN',
+                        help='只处理匹配的目录（通配符，可多次指定；含 / 时匹配相对路径）')
+    parser.add_argument('--exclude', action='append', default=None, metavar='PATTERN',
+                        help='跳过匹配的目录及其下级目录（通配符，可多次指定）')
+    parser.add_argument('--conflict', choices=CONFLICT_POLICIES, default=None,
+                        help='目标文件已存在时的默认处理策略（目标目录自己的 --conflict 优先）')
+    parser.add_argument('--headless', action='store_true',
+                        help='无人值守运行：不询问、结束时不等待按键（标准输入不是终端时自动启用）')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='预演：只打印复制/删除计划和字节数合计，不改动任何文件')
+    parser.add_argument('--settle', type=float, default=DEFAULT_WATCH_SETTLE,
+                        help=f'文件持续多少秒不变才开始复制（默认 {DEFAULT_WATCH_SETTLE:g}）')
+    parser.add_argument('--throttle', type=parse_size, default=None, metavar='SIZE',
+                        help='所有目标目录合计的写入速率上限（每秒），如 50M；目标目录自己的 --throttle 另外生效')
+    parser.add_argument('--max-inflight', type=parse_size, default=None, metavar='SIZE',
+                        help='同时复制的文件总大小上限，如 2G')
+    parser.add_argument('--priority', choices=COPY_PRIORITIES, default=None,
+                        help='复制顺序：small-first=小文件优先（默认），plan=按扫描顺序')
+    parser.add_argument('--report', default=None, metavar='PATH',
+                        help='把本次运行的各阶段耗时和计数保存为 JSON 报告')
+    parser.add_argument('--profile', action='store_true',
+                        help=f'用 cProfile/tracemalloc 分析本次运行，结果保存在报告旁边（默认 {DEFAULT_REPORT_PATH}）')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    def wait_for_keypress():
+        try:
+            if msvcrt is not None:
+                print("\n按任意键退出...")
+                msvcrt.getch()
+                return
+            # 非 Windows 兜底
+            input("\n按回车键退出...")
+        except Exception:
+            pass
+
+    args = parse_args()
+    headless = args.headless or is_headless()
+    report_path = args.report or (DEFAULT_REPORT_PATH if args.profile else None)
+    profiler = start_profiling() if args.profile else None
+
+    try:
+        print_intro()
+        # 从配置文件读取源目录和目标目录们
+        settings = {}
+        with get_metrics().phase('config'):
+            source_directory, target_directories = read_config(
+                args.config, settings, None if args.dry_run else CONFIG_CACHE_PATH)
+        # 命令行参数优先于配置文件
+        select_policy = args.select or settings.get('select', DEFAULT_SELECT_POLICY)
+        conflict_policy = args.conflict or settings.get('conflict', DEFAULT_CONFLICT_POLICY)
+        scan_depth = args.depth if args.depth is not None else settings.get('depth', DEFAULT_SCAN_DEPTH)
+        include_patterns = args.include if args.include is not None else settings.get('include')
+        exclude_patterns = args.exclude if args.exclude is not None else settings.get('exclude')
+        scan_workers = max(1, args.scan_workers if args.scan_workers is not None
+                           else settings.get('scan_workers', DEFAULT_SCAN_WORKERS))
+        target_directories = apply_conflict_policy(target_directories, conflict_policy, headless)
+        global_throttle = args.throttle if args.throttle is not None else settings.get('throttle')
+        copy_options = {
+            'throttles': make_throttles(target_directories, global_throttle),
+            'max_inflight': args.max_inflight if args.max_inflight is not None else settings.get('max_inflight'),
+            'priority': args.priority or settings.get('priority', DEFAULT_COPY_PRIORITY),
+            'max_workers': max(1, args.copy_workers if args.copy_workers is not None
+                               else settings.get('copy_workers', DEFAULT_MAX_WORKERS)),
+            'device_concurrency': max(1, args.device_concurrency if args.device_concurrency is not None
+                                      else settings.get('device_concurrency', DEFAULT_DEVICE_CONCURRENCY)),
+        }
+
+        if not source_directory or not target_directories:
+            print("错误：无法从配置文件读取源目录或目标目录！")
+            print(f"\n请确保配置文件 {args.config} 存在且格式正确。")
+        else:
+            print("开始复制最新版本文件...")
+            print(f"源目录: {source_directory}")
+            print("目标目录配置:")
+            for idx, (td, cfg) in enumerate(target_directories, 1):
+                clean_old_status = describe_retention(cfg) if retention_enabled(cfg) else "禁用"
+                print(f"  {idx}. {td} (清理旧文件: {clean_old_status}, 已存在文件: {cfg['conflict']})")
+
+            if args.watch and not args.dry_run:
+                watch_and_copy(source_directory, target_directories, args.interval, args.settle, select_policy,
+                               scan_depth, include_patterns, exclude_patterns, scan_workers, copy_options)
+            elif not os.path.isdir(source_directory):
+                print(f"源目录不存在: {source_directory}")
+            elif args.dry_run:
+                latest_plan = build_latest_plan(source_directory, select_policy, scan_depth,
+                                                include_patterns, exclude_patterns, scan_workers)
+                copy_to_targets(latest_plan, target_directories, dry_run=True)
+            else:
+                # 只扫描一次源目录，边扫描边复制：扫描结果分批分发给所有目标目录并发复制
+                copy_streaming(source_directory, target_directories,
+                               walk_latest_groups(source_directory, scan_depth, include_patterns,
+                                                  exclude_patterns, select_policy, workers=scan_workers),
+                               **copy_options)
+                print("\n全部目标目录处理完成！")
+            if not args.dry_run and os.path.isdir(source_directory):
+                get_metrics().print_summary()
     finally:
-        wait_for_keypress()
+        if profiler is not None:
+            stop_profiling(profiler, report_path)
+        if report_path:
+            get_metrics().save(report_path)
+        if not headless:
+            wait_for_keypress()
@@ -0,0 +1,5 @@
+"""测试公共设置：把仓库根目录加入 sys.path，测试模块直接 import main"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,28 @@
+"""增量复制的回归测试"""
+import os
+
+import main
+
+
+def _delta(tmp_path, old, new):
+    (tmp_path / 'old.bin').write_bytes(old)
+    (tmp_path / 'new.bin').write_bytes(new)
+    ratio = main.delta_copy(str(tmp_path / 'new.bin'), str(tmp_path / 'out.bin'), str(tmp_path / 'old.bin'))
+    assert (tmp_path / 'out.bin').read_bytes() == new
+    return ratio
+
+
+def test_delta_resyncs_after_insertion(tmp_path):
+    old = os.urandom(4 * 1024 * 1024)
+    new = old[:1000000] + b'12345678' + old[1000000:]
+    assert _delta(tmp_path, old, new) > 0.9
+
+
+def test_delta_resyncs_after_deletion(tmp_path):
+    old = os.urandom(4 * 1024 * 1024)
+    new = old[:1000000] + old[1000100:]
+    assert _delta(tmp_path, old, new) > 0.9
+
+
+def test_delta_unrelated_data(tmp_path):
+    assert _delta(tmp_path, os.urandom(1024 * 1024), os.urandom(1024 * 1024)) == 0.0
@@ -0,0 +1,19 @@
+"""摘要缓存的回归测试"""
+
+import main
+
+
+def test_source_digest_hashed_once(tmp_path, monkeypatch):
+    src = tmp_path / 'App_1.0.exe'
+    dst = tmp_path / 'copy.exe'
+    src.write_bytes(b'x' * 1000)
+    dst.write_bytes(b'x' * 1000)
+    calls = []
+    original = main.hashlib.new
+    monkeypatch.setattr(main.hashlib, 'new', lambda name: (calls.append(name), original(name))[1])
+
+    cache = main.DigestCache()
+    assert main.files_identical(str(src), str(dst), 'blake2b', cache)
+    main.file_digest(str(src), 'blake2b', cache)
+    main.file_digest(str(src), 'blake2b', cache)
+    assert len(calls) == 2
@@ -0,0 +1,36 @@
+"""同步清单的回归测试"""
+import json
+import os
+
+import main
+
+
+def _run(source, target, monkeypatch, batch_size=1):
+    saves = []
+    original = main.save_manifest
+    monkeypatch.setattr(main, 'save_manifest', lambda td, m: (saves.append(td), original(td, m)))
+    main.copy_streaming(str(source), [(str(target), {'manifest': True})],
+                        main.walk_latest_groups(str(source)), batch_size=batch_size, announce=False)
+    with open(os.path.join(str(target), main.MANIFEST_NAME), encoding='utf-8') as f:
+        return saves, sorted(json.load(f)['files'])
+
+
+def test_manifest_saved_once_and_pruned(tmp_path, monkeypatch):
+    source = tmp_path / 'src'
+    target = tmp_path / 'dst'
+    target.mkdir()
+    for name in ('A', 'B', 'C'):
+        (source / name).mkdir(parents=True)
+        (source / name / f"{name}_1.0.exe").write_bytes(b'x')
+
+    saves, keys = _run(source, target, monkeypatch)
+    assert len(saves) == 1
+    assert keys == ['A/A_1.0.exe', 'B/B_1.0.exe', 'C/C_1.0.exe']
+
+    (source / 'A' / 'A_1.0.exe').unlink()
+    (source / 'A' / 'A_2.0.exe').write_bytes(b'y')
+    (source / 'C' / 'C_1.0.exe').unlink()
+    (source / 'C').rmdir()
+    saves, keys = _run(source, target, monkeypatch)
+    assert len(saves) == 1
+    assert keys == ['A/A_2.0.exe', 'B/B_1.0.exe']
@@ -0,0 +1,68 @@
+"""暂存文件续传与过期暂存文件清理的回归测试"""
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def small_resume(monkeypatch):
+    monkeypatch.setattr(main, 'RESUME_MIN_SIZE', 1 << 20)
+    monkeypatch.setattr(main, 'RESUME_CHECKPOINT_SIZE', 1 << 20)
+    monkeypatch.setattr(main, 'RESUME_VERIFY_SIZE', 256 * 1024)
+
+
+def test_resume_continues_from_checkpoint(tmp_path, monkeypatch, small_resume):
+    data = os.urandom(5 * (1 << 20) + 123)
+    src = tmp_path / 'src.bin'
+    dst = tmp_path / 'dst.bin'
+    src.write_bytes(data)
+
+    original = main._copy_with_backends
+    calls = []
+
+    def interrupted(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 3:
+            raise OSError("中断")
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(main, '_copy_with_backends', interrupted)
+    with pytest.raises(OSError):
+        main.copy_file(str(src), str(dst))
+    assert main.has_resume_state(str(dst))
+
+    monkeypatch.setattr(main, '_copy_with_backends', original)
+    backend = main.copy_file(str(src), str(dst))
+    assert '续传自 2.0 MB' in backend
+    assert dst.read_bytes() == data
+    assert sorted(os.listdir(tmp_path)) == ['dst.bin', 'src.bin']
+
+
+def test_resume_restarts_when_part_differs(tmp_path, small_resume):
+    data = os.urandom(3 * (1 << 20))
+    src = tmp_path / 'src.bin'
+    src.write_bytes(data)
+    part = tmp_path / '.dst.bin.copy4bk-part'
+    part.write_bytes(b'\0' * (2 << 20))
+    main._save_progress(main._progress_path(str(part)), os.stat(str(src)), 2 << 20)
+
+    backend = main.copy_file(str(src), str(tmp_path / 'dst.bin'))
+    assert '续传' not in backend
+    assert (tmp_path / 'dst.bin').read_bytes() == data
+
+
+def test_remove_stale_staging_keeps_failed_only(tmp_path):
+    subdir = tmp_path / 'App'
+    subdir.mkdir()
+    for name in ('.App_1.0.exe.copy4bk-part', '.App_1.0.exe.copy4bk-part.json',
+                 '.App_2.0.exe.copy4bk-part', '.App_2.0.exe.copy4bk-part.json', '.App_2.0.exe.copy4bk-delta',
+                 'App_1.0.exe'):
+        (subdir / name).write_bytes(b'x')
+    plan = main.LatestPlan(str(tmp_path), [main.PlanEntry('App', [])])
+
+    removed = main.remove_stale_staging(str(tmp_path), plan, [str(subdir / 'App_2.0.exe')])
+    assert removed == 3
+    assert sorted(os.listdir(subdir)) == ['.App_2.0.exe.copy4bk-part', '.App_2.0.exe.copy4bk-part.json',
+                                          'App_1.0.exe']
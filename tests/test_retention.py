@@ -0,0 +1,43 @@
+"""保留规则的回归测试"""
+import os
+
+import main
+
+
+def _make_target(tmp_path, old_versions, size=100):
+    subdir = tmp_path / 'target' / 'App'
+    subdir.mkdir(parents=True)
+    for i, version in enumerate(old_versions):
+        path = subdir / f"App_{version}.exe"
+        path.write_bytes(b'x' * size)
+        os.utime(path, (1_600_000_000 + i, 1_600_000_000 + i))
+    (subdir / 'App_2.0.exe').write_bytes(b'x' * size)
+    src = tmp_path / 'src' / 'App'
+    src.mkdir(parents=True)
+    (src / 'App_2.0.exe').write_bytes(b'x' * size)
+    plan = main.build_latest_plan(str(tmp_path / 'src'))
+    return plan, tmp_path / 'target', subdir
+
+
+def test_max_bytes_only_keeps_old_versions_below_cap(tmp_path):
+    plan, target, subdir = _make_target(tmp_path, ['1.0', '1.1', '1.2'])
+    deleted = main.apply_retention(plan, str(target), {'max_bytes': main.parse_size('20G')})
+    assert deleted == []
+    assert len(os.listdir(subdir)) == 4
+
+
+def test_max_bytes_only_removes_oldest_over_cap(tmp_path):
+    plan, target, subdir = _make_target(tmp_path, ['1.0', '1.1', '1.2'])
+    main.apply_retention(plan, str(target), {'max_bytes': 250})
+    assert sorted(os.listdir(subdir)) == ['App_1.2.exe', 'App_2.0.exe']
+
+
+def test_clean_old_keeps_only_latest(tmp_path):
+    plan, target, subdir = _make_target(tmp_path, ['1.0', '1.1'])
+    main.apply_retention(plan, str(target), {'clean_old': True})
+    assert os.listdir(subdir) == ['App_2.0.exe']
+
+
+def test_plan_retention_unlimited_keep(tmp_path):
+    _, _, subdir = _make_target(tmp_path, ['1.0', '1.1'])
+    assert main.plan_retention(str(subdir), ['App_2.0.exe'], keep=None, max_bytes=None) == []